@@ -13,6 +13,7 @@ import torch
 import torch.utils.data as data
 
 import multiprocessing
+import collections
 import six
 
 CACHED_FLICKR30K_ATT = None
@@ -22,6 +23,7 @@ class HybridLoader:
     """
     If db_path is a director, then use normal file loading
     If lmdb, then load from lmdb
+    If packed, then read from a single memory-mapped file (see scripts/dump_to_packed.py)
     The loading method depend on extention.
     """
 
@@ -51,6 +53,22 @@ class HybridLoader:
             self.feat_file = CACHED_FLICKR30K_ATT
             self.loader = lambda x: x
             print("HybridLoader: ext is ignored")
+        elif db_path.endswith(".packed"):
+            # One contiguous float array plus an {id: [offset, shape]} index.
+            # The array is memory-mapped, so the loader workers share the page cache
+            # instead of each holding its own copy of the features.
+            self.db_type = "packed"
+            with open(os.path.join(db_path, "index.json")) as f:
+                index = json.load(f)
+            self.index = index["feats"]
+            self.feat_file = np.memmap(
+                os.path.join(db_path, "feats.bin"),
+                dtype=index["dtype"],
+                mode="r",
+                shape=(index["size"],),
+            )
+            self.loader = lambda x: x
+            print("HybridLoader: ext is ignored")
         else:
             self.db_type = "dir"
 
@@ -58,10 +76,15 @@ class HybridLoader:
         if self.db_type == "lmdb":
             env = self.env
             with env.begin(write=False) as txn:
-                byteflow = txn.get(key)
+                byteflow = txn.get(six.ensure_binary(key))
             f_input = six.BytesIO(byteflow)
         elif self.db_type == "pth":
             f_input = self.feat_file[key]
+        elif self.db_type == "packed":
+            offset, shape = self.index[key]
+            f_input = self.feat_file[offset : offset + int(np.prod(shape))].reshape(
+                shape
+            )
         else:
             f_input = os.path.join(self.db_path, key + self.ext)
 
@@ -97,6 +120,8 @@ class DataLoader(data.Dataset):
         self.use_box = getattr(opt, "use_box", 0)
         self.norm_att_feat = getattr(opt, "norm_att_feat", 0)
         self.norm_box_feat = getattr(opt, "norm_box_feat", 0)
+        self.batched_collate = getattr(opt, "batched_collate", 0)
+        self.dedup_feats = getattr(opt, "dedup_feats", 0)
 
         # load the json file which contains additional information about the dataset
         print("DataLoader loading json file: ", opt.input_json)
@@ -194,7 +219,43 @@ class DataLoader(data.Dataset):
 
     def get_batch(self, split, batch_size=None):
         batch_size = batch_size or self.batch_size
+
+        if self.batched_collate:
+            # the loader workers already collated the batch
+            assert (
+                batch_size == self.batch_size
+            ), "batched_collate only supports the batch_size the loader was built with"
+            data, wrapped = self._prefetch_process[split].get_batch(batch_size)
+        else:
+            batch = []
+            wrapped = False
+            for i in range(batch_size):
+                # fetch image
+                tmp_fc, tmp_att, tmp_seq, ix, tmp_wrapped = self._prefetch_process[
+                    split
+                ].get()
+                if tmp_wrapped:
+                    wrapped = True
+                batch.append((tmp_fc, tmp_att, tmp_seq, ix))
+            data = self.collate_func(batch)
+
+        data["bounds"] = {
+            "it_pos_now": self.iterators[split],
+            "it_max": len(self.split_ix[split]),
+            "wrapped": wrapped,
+        }
+
+        return data
+
+    def collate_func(self, batch):
+        """
+        Merge a list of (fc_feat, att_feat, seq, ix) tuples, as returned by __getitem__,
+        into a batch: pad and stack the features, build the masks and the labels.
+        Run by the loader workers when batched_collate is set.
+        """
         seq_per_img = self.seq_per_img
+        # number of copies of the features of each image
+        feat_per_img = 1 if self.dedup_feats else seq_per_img
 
         fc_batch = (
             []
@@ -206,19 +267,10 @@ class DataLoader(data.Dataset):
             []
         )  # np.zeros([batch_size * seq_per_img, self.seq_length + 2], dtype = 'int')
 
-        wrapped = False
-
         infos = []
         gts = []
 
-        for i in range(batch_size):
-            # fetch image
-            tmp_fc, tmp_att, tmp_seq, ix, tmp_wrapped = self._prefetch_process[
-                split
-            ].get()
-            if tmp_wrapped:
-                wrapped = True
-
+        for tmp_fc, tmp_att, tmp_seq, ix in batch:
             fc_batch.append(tmp_fc)
             att_batch.append(tmp_att)
 
@@ -253,21 +305,21 @@ class DataLoader(data.Dataset):
             )
         )
         data = {}
-        data["fc_feats"] = np.stack(sum([[_] * seq_per_img for _ in fc_batch], []))
+        data["fc_feats"] = np.stack(sum([[_] * feat_per_img for _ in fc_batch], []))
         # merge att_feats
         max_att_len = max([_.shape[0] for _ in att_batch])
         data["att_feats"] = np.zeros(
-            [len(att_batch) * seq_per_img, max_att_len, att_batch[0].shape[1]],
+            [len(att_batch) * feat_per_img, max_att_len, att_batch[0].shape[1]],
             dtype="float32",
         )
         for i in range(len(att_batch)):
             data["att_feats"][
-                i * seq_per_img : (i + 1) * seq_per_img, : att_batch[i].shape[0]
+                i * feat_per_img : (i + 1) * feat_per_img, : att_batch[i].shape[0]
             ] = att_batch[i]
         data["att_masks"] = np.zeros(data["att_feats"].shape[:2], dtype="float32")
         for i in range(len(att_batch)):
             data["att_masks"][
-                i * seq_per_img : (i + 1) * seq_per_img, : att_batch[i].shape[0]
+                i * feat_per_img : (i + 1) * feat_per_img, : att_batch[i].shape[0]
             ] = 1
         # set att_masks to None if attention features have same length
         if data["att_masks"].sum() == data["att_masks"].size:
@@ -284,11 +336,6 @@ class DataLoader(data.Dataset):
         data["masks"] = mask_batch
 
         data["gts"] = gts  # all ground truth captions of each images
-        data["bounds"] = {
-            "it_pos_now": self.iterators[split],
-            "it_max": len(self.split_ix[split]),
-            "wrapped": wrapped,
-        }
         data["infos"] = infos
 
         data = {
@@ -358,6 +405,44 @@ class SubsetSampler(torch.utils.data.sampler.Sampler):
         return len(self.indices)
 
 
+class InfiniteBatchSampler(torch.utils.data.sampler.Sampler):
+    r"""Yields batches of indices forever, starting from indices[start:].
+    At the end of every epoch, a new order is drawn (shuffled if shuffle) and
+    appended to orders, so that the main process can follow it.
+    Arguments:
+        indices (list): a list of indices
+        start (int): position in indices of the first index
+        batch_size (int): number of indices per batch
+        shuffle (bool): if reshuffle the indices at every epoch
+        orders (collections.deque): where the orders of the next epochs are put
+    """
+
+    def __init__(self, indices, start, batch_size, shuffle, orders):
+        self.indices = indices
+        self.start = start
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.orders = orders
+
+    def __iter__(self):
+        indices = self.indices
+        ri = self.start
+        batch = []
+        while True:
+            batch.append(indices[ri])
+            ri += 1
+            if ri >= len(indices):
+                ri = 0
+                # never shuffle in place, the main process still reads the current order
+                indices = list(indices)
+                if self.shuffle:
+                    random.shuffle(indices)
+                self.orders.append(indices)
+            if len(batch) == self.batch_size:
+                yield batch
+                batch = []
+
+
 class BlobFetcher:
     """Experimental class for prefetching blobs in a separate process."""
 
@@ -376,6 +461,26 @@ class BlobFetcher:
         1. not hasattr(self, 'split_loader'): Resume from previous training. Create the dataset given the saved split_ix and iterator
         2. wrapped: a new epoch, the split_ix and iterator have been updated in the get_minibatch_inds already.
         """
+        if self.dataloader.batched_collate:
+            # The workers collate whole batches. The sampler never stops, so the
+            # workers are not restarted at every epoch.
+            self.orders = collections.deque()
+            self.split_loader = iter(
+                data.DataLoader(
+                    dataset=self.dataloader,
+                    batch_sampler=InfiniteBatchSampler(
+                        self.dataloader.split_ix[self.split],
+                        self.dataloader.iterators[self.split],
+                        self.dataloader.batch_size,
+                        self.if_shuffle,
+                        self.orders,
+                    ),
+                    pin_memory=True,
+                    num_workers=4,  # 4 is usually enough
+                    collate_fn=self.dataloader.collate_func,
+                )
+            )
+            return
         # batch_size is 1, the merge is done in DataLoader class
         self.split_loader = iter(
             data.DataLoader(
@@ -403,7 +508,10 @@ class BlobFetcher:
         ri_next = ri + 1
         if ri_next >= max_index:
             ri_next = 0
-            if self.if_shuffle:
+            if self.dataloader.batched_collate:
+                # the sampler has already drawn the order of the next epoch
+                self.dataloader.split_ix[self.split] = self.orders.popleft()
+            elif self.if_shuffle:
                 random.shuffle(self.dataloader.split_ix[self.split])
             wrapped = True
         self.dataloader.iterators[self.split] = ri_next
@@ -422,3 +530,19 @@ class BlobFetcher:
         assert tmp[-1] == ix, "ix not equal"
 
         return tmp + [wrapped]
+
+    def get_batch(self, batch_size):
+        if not hasattr(self, "split_loader"):
+            self.reset()
+
+        wrapped = False
+        ixs = []
+        for i in range(batch_size):
+            ix, tmp_wrapped = self._get_next_minibatch_inds()
+            wrapped = wrapped or tmp_wrapped
+            ixs.append(ix)
+        tmp = next(self.split_loader)
+
+        assert [_["ix"] for _ in tmp["infos"]] == ixs, "ix not equal"
+
+        return tmp, wrapped
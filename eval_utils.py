@@ -150,11 +150,12 @@ def eval_split(model, crit, loader, eval_kwargs={}):
 
         # forward the model to also get generated samples for each image
         # Only leave one feature for each image, in case duplicate sample
+        feat_per_img = 1 if getattr(loader, "dedup_feats", 0) else loader.seq_per_img
         tmp = [
-            data["fc_feats"][np.arange(loader.batch_size) * loader.seq_per_img],
-            data["att_feats"][np.arange(loader.batch_size) * loader.seq_per_img],
+            data["fc_feats"][np.arange(loader.batch_size) * feat_per_img],
+            data["att_feats"][np.arange(loader.batch_size) * feat_per_img],
             (
-                data["att_masks"][np.arange(loader.batch_size) * loader.seq_per_img]
+                data["att_masks"][np.arange(loader.batch_size) * feat_per_img]
                 if data["att_masks"] is not None
                 else None
             ),
@@ -0,0 +1,237 @@
+"""
+CIDEr-D for self critical training, on token ids and with the references
+precomputed.
+
+The references of the training images never change, so instead of cooking them
+from strings at every batch like pyciderevalcap's CiderD, CiderDIndex cooks the
+labels of every image of input_label_h5 once, with the document frequencies of
+cached_tokens, and looks them up by image index. Only the generated captions
+are processed at each step.
+
+Everything works on arrays of token ids: an n-gram is hashed into an integer
+(see cook), and the tf-idf vectors, their norms, the clipped dot products and
+the length penalty are computed for the whole batch with numpy. The scores are
+the ones of CiderD(df=cached_tokens), up to float rounding.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import os
+
+import h5py
+import numpy as np
+
+import misc.utils as utils
+
+# the n-gram (w_1, ..., w_k) is hashed into sum((w_i + 1) * BASE ** (k - i)), so
+# token ids have to be smaller than BASE - 1, and k <= 4 fits in a uint64
+BASE = np.uint64(2**16)
+
+
+def ngram_order(keys):
+    """
+    k - 1 for the hashes of k-grams
+    """
+    order = np.zeros(keys.shape, dtype=np.int64)
+    for k in range(1, 4):
+        order += keys >= BASE**k
+    return order
+
+
+def cook(seqs, n=4):
+    """
+    Term frequencies of the 1 to n-grams of N captions.
+    seqs: N x L token ids, each caption is cut after its first 0, like
+        misc.rewards.array_to_str does
+    returns the caption of each n-gram, the hash of the n-gram, its term frequency
+    (sorted by caption then hash), and the number of bigrams of each caption
+    """
+    seqs = np.asarray(seqs).astype(np.int64)
+    assert seqs.size == 0 or seqs.max() < BASE - 1, "token ids too large to hash"
+    N, L = seqs.shape
+    # number of words, the first 0 included
+    is_end = seqs == 0
+    lengths = np.where(is_end.any(1), is_end.argmax(1) + 1, L)
+    words = (seqs + 1).astype(np.uint64)
+
+    rows, keys = [], []
+    key = np.zeros((N, L + 1), dtype=np.uint64)
+    for k in range(1, n + 1):
+        # hash of the k-grams starting at each position, from the (k-1)-grams
+        key = key[:, : L - k + 1] * BASE + words[:, k - 1 :]
+        row, start = np.nonzero(np.arange(L - k + 1) + k <= lengths[:, None])
+        rows.append(row)
+        keys.append(key[row, start])
+    rows, keys = np.concatenate(rows), np.concatenate(keys)
+
+    # count the occurrences of each (caption, n-gram)
+    order = np.lexsort((keys, rows))
+    rows, keys = rows[order], keys[order]
+    first = np.ones(len(keys), dtype=bool)
+    first[1:] = (rows[1:] != rows[:-1]) | (keys[1:] != keys[:-1])
+    first = np.flatnonzero(first)
+    term_freq = np.diff(np.append(first, len(keys)))
+    return rows[first], keys[first], term_freq, np.maximum(lengths - 1, 0)
+
+
+def ngram_key(ngram):
+    """
+    The hash of cook of an n-gram given as a tuple of token ids (or their str)
+    """
+    key = np.uint64(0)
+    for w in ngram:
+        key = key * BASE + np.uint64(int(w) + 1)
+    return key
+
+
+def df_to_arrays(document_frequency):
+    """
+    The n-gram hashes of a document frequency dict of prepro_ngrams.py, sorted,
+    and their document frequencies
+    """
+    keys = np.array([ngram_key(ngram) for ngram in document_frequency], dtype=np.uint64)
+    values = np.array(list(document_frequency.values()), dtype=np.float64)
+    order = np.argsort(keys)
+    return keys[order], values[order]
+
+
+# binary document frequency file: magic, ref_len (float64), number of n-grams
+# (uint64), then the sorted n-gram hashes (uint64) and their frequencies (float32)
+DF_MAGIC = b"CIDERDF1"
+
+
+def save_df(path, document_frequency, ref_len):
+    keys, values = df_to_arrays(document_frequency)
+    with open(path, "wb") as f:
+        f.write(DF_MAGIC)
+        f.write(np.array([ref_len], dtype=np.float64).tobytes())
+        f.write(np.array([len(keys)], dtype=np.uint64).tobytes())
+        f.write(keys.tobytes())
+        f.write(values.astype(np.float32).tobytes())
+
+
+def load_df(path):
+    """
+    ref_len, and the n-gram hashes and frequencies of save_df, memory-mapped
+    """
+    with open(path, "rb") as f:
+        assert f.read(len(DF_MAGIC)) == DF_MAGIC, "%s is not a df file" % path
+        ref_len = float(np.frombuffer(f.read(8), dtype=np.float64)[0])
+        count = int(np.frombuffer(f.read(8), dtype=np.uint64)[0])
+    offset = len(DF_MAGIC) + 16
+    keys = np.memmap(path, dtype=np.uint64, mode="r", offset=offset, shape=(count,))
+    values = np.memmap(
+        path, dtype=np.float32, mode="r", offset=offset + 8 * count, shape=(count,)
+    )
+    return ref_len, keys, values
+
+
+class CiderDIndex(object):
+    def __init__(self, input_label_h5, df, n=4, sigma=6.0):
+        self.n = n
+        self.sigma = sigma
+        if os.path.isfile(os.path.join("data", df + ".bin")):
+            # written by prepro_ngrams.py --df_format bin, memory-mapped
+            self.ref_len, self.df_keys, self.df_values = load_df(
+                os.path.join("data", df + ".bin")
+            )
+        else:
+            # same file as CiderD(df=df)
+            pkl_file = utils.pickle_load(open(os.path.join("data", df + ".p"), "rb"))
+            self.df_keys, self.df_values = df_to_arrays(pkl_file["document_frequency"])
+            self.ref_len = float(pkl_file["ref_len"])
+        self.ref_len = np.log(self.ref_len)
+
+        with h5py.File(input_label_h5, "r") as f:
+            labels = f["labels"][:]
+            # the references of image ix are labels[label_start_ix[ix] - 1 : label_end_ix[ix]]
+            self.label_start_ix = f["label_start_ix"][:].astype(np.int64) - 1
+            self.label_end_ix = f["label_end_ix"][:].astype(np.int64)
+
+        rows, keys, term_freq, self.ref_length = cook(labels, self.n)
+        self.ref_vec, self.ref_norm = self.counts2vec(
+            rows, keys, term_freq, len(labels)
+        )
+        # the n-grams of the references are looked up by their rank among all of
+        # them; (reference, rank) is coded into one sorted int64 for searchsorted
+        self.ref_ngrams = np.unique(keys)
+        self.ref_code = rows * len(self.ref_ngrams) + np.searchsorted(
+            self.ref_ngrams, keys
+        )
+
+    def counts2vec(self, rows, keys, term_freq, num):
+        """
+        Tf-idf of the n-grams of cook and the n norms of each of the num captions
+        """
+        pos = np.minimum(np.searchsorted(self.df_keys, keys), len(self.df_keys) - 1)
+        df = np.where(
+            self.df_keys[pos] == keys, self.df_values[pos].astype(np.float64), 0.0
+        )
+        # give word count 1 if it doesn't appear in reference corpus
+        vec = term_freq * (self.ref_len - np.log(np.maximum(1.0, df)))
+        norm = np.bincount(
+            rows * self.n + ngram_order(keys),
+            weights=vec**2,
+            minlength=num * self.n,
+        )
+        return vec, np.sqrt(norm).reshape(num, self.n)
+
+    def compute_score(self, res, img_ix):
+        """
+        res: N x L array of generated captions
+        img_ix: N image indices (the ix of the loader infos) of the captions
+        returns the average score and the N scores
+        """
+        res = np.asarray(res)
+        img_ix = np.asarray(img_ix, dtype=np.int64)
+        N = len(res)
+        rows, keys, term_freq, length = cook(res, self.n)
+        vec, norm = self.counts2vec(rows, keys, term_freq, N)
+
+        # pairs of a caption and one of the references of its image
+        num_refs = self.label_end_ix[img_ix] - self.label_start_ix[img_ix]
+        pair_start = np.cumsum(num_refs) - num_refs
+        pair_hyp = np.repeat(np.arange(N), num_refs)
+        pair_ref = (
+            np.arange(num_refs.sum())
+            - np.repeat(pair_start, num_refs)
+            + np.repeat(self.label_start_ix[img_ix], num_refs)
+        )
+
+        # look the n-grams of each caption up in each of its references, the
+        # n-grams no reference has can't match
+        rank = np.minimum(
+            np.searchsorted(self.ref_ngrams, keys), len(self.ref_ngrams) - 1
+        )
+        seen = np.flatnonzero(self.ref_ngrams[rank] == keys)
+        rep = num_refs[rows[seen]]
+        entry = np.repeat(seen, rep)
+        pair = (
+            np.repeat(pair_start[rows[seen]], rep)
+            + np.arange(rep.sum())
+            - np.repeat(np.cumsum(rep) - rep, rep)
+        )
+        code = pair_ref[pair] * len(self.ref_ngrams) + rank[entry]
+        pos = np.minimum(np.searchsorted(self.ref_code, code), len(self.ref_code) - 1)
+        match = self.ref_code[pos] == code
+        entry, pair, pos = entry[match], pair[match], pos[match]
+
+        # clipped dot products, pairs x n
+        val = np.bincount(
+            pair * self.n + ngram_order(keys[entry]),
+            weights=np.minimum(vec[entry], self.ref_vec[pos]) * self.ref_vec[pos],
+            minlength=len(pair_hyp) * self.n,
+        ).reshape(-1, self.n)
+        norms = norm[pair_hyp] * self.ref_norm[pair_ref]
+        val = np.where(norms != 0, val / np.where(norms != 0, norms, 1.0), val)
+        # length based gaussian penalty
+        delta = (length[pair_hyp] - self.ref_length[pair_ref]).astype(np.float64)
+        val *= np.e ** (-(delta**2) / (2 * self.sigma**2))[:, None]
+
+        # average over the n-grams and the references
+        score = np.zeros((N, self.n))
+        np.add.at(score, pair_hyp, val)
+        scores = score.mean(1) / num_refs * 10.0
+        return np.mean(scores), scores
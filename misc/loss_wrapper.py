@@ -8,38 +8,107 @@ class LossWrapper(torch.nn.Module):
         super(LossWrapper, self).__init__()
         self.opt = opt
         self.model = model
-        if opt.label_smoothing > 0:
+        if opt.label_smoothing > 0 and getattr(opt, "closed_form_smoothing", 0):
+            self.crit = utils.ClosedFormLabelSmoothing(smoothing=opt.label_smoothing)
+        elif opt.label_smoothing > 0:
             self.crit = utils.LabelSmoothing(smoothing=opt.label_smoothing)
         else:
             self.crit = utils.LanguageModelCriterion()
         self.rl_crit = utils.RewardCriterion()
 
     def forward(
-        self, fc_feats, att_feats, labels, masks, att_masks, gts, gt_indices, sc_flag
+        self,
+        fc_feats,
+        att_feats,
+        labels,
+        masks,
+        att_masks,
+        gts,
+        gt_indices,
+        sc_flag,
+        img_ix=None,
     ):
         out = {}
         if not sc_flag:
-            loss = self.crit(
-                self.model(fc_feats, att_feats, labels, att_masks),
-                labels[:, 1:],
-                masks[:, 1:],
-            )
+            if getattr(self.opt, "fused_loss", 0):
+                loss = self.model(
+                    fc_feats, att_feats, labels, att_masks, crit=self.crit, masks=masks
+                )
+            else:
+                loss = self.crit(
+                    self.model(fc_feats, att_feats, labels, att_masks),
+                    labels[:, 1:],
+                    masks[:, 1:],
+                )
+            if getattr(self.opt, "shortlist_predictor", 0):
+                loss = loss + self.model(
+                    att_feats, att_masks, labels, mode="shortlist_loss"
+                )
         else:
+            seq_per_img = labels.size(0) // fc_feats.size(0)
+            kwargs = {}
+            if getattr(self.opt, "share_sc_encoder", 0) and hasattr(
+                self.model, "_prepare_feature"
+            ):
+                # one encoder pass, in train mode, for both decodes below; the
+                # greedy one doesn't track gradients, the sampled one does
+                kwargs["prepared_feats"] = self.model(
+                    fc_feats, att_feats, att_masks, mode="prepare_feature"
+                )
+                if seq_per_img > 1:
+                    kwargs["prepared_feats"] = utils.repeat_tensors(
+                        seq_per_img, kwargs["prepared_feats"]
+                    )
+            if seq_per_img > 1:
+                # the features were given once per image, sample once per caption
+                fc_feats, att_feats, att_masks = utils.repeat_tensors(
+                    seq_per_img, [fc_feats, att_feats, att_masks]
+                )
+            greedy_feats, greedy_kwargs = [fc_feats, att_feats, att_masks], kwargs
+            if getattr(self.opt, "greedy_per_img", 0):
+                # the greedy captions of an image are all the same, decode one
+                # per image; get_self_critical_reward broadcasts its score
+                rows = torch.arange(
+                    0,
+                    labels.size(0),
+                    labels.size(0) // len(gt_indices),
+                    device=labels.device,
+                )
+                greedy_feats = utils.select_tensors(greedy_feats, rows)
+                greedy_kwargs = {
+                    k: utils.select_tensors(v, rows) for k, v in kwargs.items()
+                }
+            compact_finished = getattr(self.opt, "compact_finished", 0)
             self.model.eval()
             with torch.no_grad():
                 greedy_res, _ = self.model(
-                    fc_feats, att_feats, att_masks, mode="sample"
+                    *greedy_feats,
+                    opt={"compact_finished": compact_finished},
+                    mode="sample",
+                    **greedy_kwargs
                 )
             self.model.train()
             gen_result, sample_logprobs = self.model(
                 fc_feats,
                 att_feats,
                 att_masks,
-                opt={"sample_method": "sample"},
+                opt={"sample_method": "sample", "compact_finished": compact_finished},
                 mode="sample",
+                **kwargs
             )
+            if getattr(self.opt, "reward_workers", 0):
+                # the rewards are scored by the RewardPool of train.py, which
+                # computes the loss with rl_crit once they are known
+                out["greedy_res"] = greedy_res
+                out["gen_result"] = gen_result
+                out["sample_logprobs"] = sample_logprobs
+                return out
             gts = [gts[_] for _ in gt_indices.tolist()]
-            reward = get_self_critical_reward(greedy_res, gts, gen_result, self.opt)
+            if img_ix is not None:
+                img_ix = img_ix.tolist()
+            reward = get_self_critical_reward(
+                greedy_res, gts, gen_result, self.opt, img_ix
+            )
             reward = torch.from_numpy(reward).float().to(gen_result.device)
             loss = self.rl_crit(sample_logprobs, gen_result.data, reward)
             out["reward"] = reward[:, 0].mean()
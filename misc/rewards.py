@@ -4,6 +4,8 @@ from __future__ import print_function
 
 import numpy as np
 import time
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
 import misc.utils as utils
 from collections import OrderedDict
 import torch
@@ -16,14 +18,24 @@ from pyciderevalcap.ciderD.ciderD import CiderD
 sys.path.append("coco-caption")
 from pycocoevalcap.bleu.bleu import Bleu
 
+from misc.cider import CiderDIndex
+
 CiderD_scorer = None
+CiderD_index = None
 Bleu_scorer = None
 # CiderD_scorer = CiderD(df='corpus')
 
 
-def init_scorer(cached_tokens):
-    global CiderD_scorer
-    CiderD_scorer = CiderD_scorer or CiderD(df=cached_tokens)
+def init_scorer(cached_tokens, input_label_h5=None):
+    if input_label_h5:
+        # precomputed references, the image indices have to be given to
+        # get_self_critical_reward. It reads cached_tokens from data/ as a .bin
+        # file if there is one, so that the pickle is never loaded
+        global CiderD_index
+        CiderD_index = CiderD_index or CiderDIndex(input_label_h5, cached_tokens)
+    else:
+        global CiderD_scorer
+        CiderD_scorer = CiderD_scorer or CiderD(df=cached_tokens)
     global Bleu_scorer
     Bleu_scorer = Bleu_scorer or Bleu(4)
 
@@ -37,43 +49,149 @@ def array_to_str(arr):
     return out.strip()
 
 
-def get_self_critical_reward(greedy_res, data_gts, gen_result, opt):
+def get_self_critical_reward(greedy_res, data_gts, gen_result, opt, img_ix=None):
+    """
+    img_ix, the indices of the images of data_gts in the dataset, lets CiderD_index
+    score the captions against its precomputed references.
+    """
+    rewards, averages = _self_critical_reward(
+        greedy_res, data_gts, gen_result, opt, img_ix
+    )
+    for name, average in averages.items():
+        print(name + " scores:", average)
+    return rewards
+
+
+def _self_critical_reward(greedy_res, data_gts, gen_result, opt, img_ix=None):
+    """
+    get_self_critical_reward without printing: returns the rewards and the
+    average score of the captions for each metric, {name: average}.
+    """
     batch_size = gen_result.size(0)  # batch_size = sample_size * seq_per_img
     seq_per_img = batch_size // len(data_gts)
-
-    res = OrderedDict()
+    # the greedy baseline is given either once per sample or once per image
+    greedy_size = greedy_res.size(0)
+    greedy_per_img = greedy_size // len(data_gts)
+    use_index = CiderD_index is not None
+    averages = OrderedDict()
+    assert not use_index or img_ix is not None, "CiderD_index needs img_ix"
 
     gen_result = gen_result.data.cpu().numpy()
     greedy_res = greedy_res.data.cpu().numpy()
-    for i in range(batch_size):
-        res[i] = [array_to_str(gen_result[i])]
-    for i in range(batch_size):
-        res[batch_size + i] = [array_to_str(greedy_res[i])]
-
-    gts = OrderedDict()
-    for i in range(len(data_gts)):
-        gts[i] = [array_to_str(data_gts[i][j]) for j in range(len(data_gts[i]))]
-
-    res_ = [{"image_id": i, "caption": res[i]} for i in range(2 * batch_size)]
-    res__ = {i: res[i] for i in range(2 * batch_size)}
-    gts = {i: gts[i % batch_size // seq_per_img] for i in range(2 * batch_size)}
+
+    if not use_index or opt.bleu_reward_weight > 0:
+        res = OrderedDict()
+        for i in range(batch_size):
+            res[i] = [array_to_str(gen_result[i])]
+        for i in range(greedy_size):
+            res[batch_size + i] = [array_to_str(greedy_res[i])]
+
+        gts = OrderedDict()
+        for i in range(len(data_gts)):
+            gts[i] = [array_to_str(data_gts[i][j]) for j in range(len(data_gts[i]))]
+
+        res_ = [
+            {"image_id": i, "caption": res[i]} for i in range(batch_size + greedy_size)
+        ]
+        res__ = {i: res[i] for i in range(batch_size + greedy_size)}
+        gts = dict(
+            [(i, gts[i // seq_per_img]) for i in range(batch_size)]
+            + [(batch_size + i, gts[i // greedy_per_img]) for i in range(greedy_size)]
+        )
     if opt.cider_reward_weight > 0:
-        _, cider_scores = CiderD_scorer.compute_score(gts, res_)
-        print("Cider scores:", _)
+        if use_index:
+            img_ix = np.asarray(img_ix)
+            _, cider_scores = CiderD_index.compute_score(
+                np.concatenate([gen_result, greedy_res]),
+                np.concatenate(
+                    [
+                        np.repeat(img_ix, seq_per_img),
+                        np.repeat(img_ix, greedy_per_img),
+                    ]
+                ),
+            )
+        else:
+            _, cider_scores = CiderD_scorer.compute_score(gts, res_)
+        averages["Cider"] = _
     else:
         cider_scores = 0
     if opt.bleu_reward_weight > 0:
         _, bleu_scores = Bleu_scorer.compute_score(gts, res__)
         bleu_scores = np.array(bleu_scores[3])
-        print("Bleu scores:", _[3])
+        averages["Bleu"] = _[3]
     else:
         bleu_scores = 0
     scores = (
         opt.cider_reward_weight * cider_scores + opt.bleu_reward_weight * bleu_scores
     )
 
-    scores = scores[:batch_size] - scores[batch_size:]
+    scores = scores[:batch_size] - np.repeat(
+        scores[batch_size:], seq_per_img // greedy_per_img
+    )
 
     rewards = np.repeat(scores[:, np.newaxis], gen_result.shape[1], 1)
 
-    return rewards
+    return rewards, averages
+
+
+class RewardPool(object):
+    """
+    Computes get_self_critical_reward in worker processes, each with its own
+    scorers, so that the rewards of a batch are scored while the training loop
+    goes on. A batch is split by images between the workers.
+    """
+
+    def __init__(self, num_workers, cached_tokens, input_label_h5=None):
+        self.num_workers = num_workers
+        self.pool = ProcessPoolExecutor(
+            num_workers,
+            # fork: the workers only use numpy, and train.py has no __main__ guard
+            mp_context=multiprocessing.get_context("fork"),
+            initializer=init_scorer,
+            initargs=(cached_tokens, input_label_h5),
+        )
+
+    def submit(self, greedy_res, data_gts, gen_result, opt, img_ix=None):
+        """
+        Same arguments as get_self_critical_reward; returns what result() takes
+        to get the rewards.
+        """
+        greedy_res, gen_result = greedy_res.cpu(), gen_result.cpu()
+        seq_per_img = gen_result.size(0) // len(data_gts)
+        greedy_per_img = greedy_res.size(0) // len(data_gts)
+        bounds = np.linspace(0, len(data_gts), self.num_workers + 1).astype(int)
+        pending = []
+        for a, b in zip(bounds[:-1], bounds[1:]):
+            if a == b:
+                continue
+            pending.append(
+                self.pool.submit(
+                    _self_critical_reward,
+                    greedy_res[a * greedy_per_img : b * greedy_per_img],
+                    data_gts[a:b],
+                    gen_result[a * seq_per_img : b * seq_per_img],
+                    opt,
+                    None if img_ix is None else list(img_ix[a:b]),
+                )
+            )
+        return pending
+
+    def result(self, pending):
+        """
+        The rewards of a batch given to submit, waits for them if needed
+        """
+        results = [_.result() for _ in pending]
+        # each worker averages the scores of its images only, the batch average
+        # weights them by the captions of each worker
+        weights = [len(rewards) for rewards, _ in results]
+        for name in results[0][1]:
+            print(
+                name + " scores:",
+                np.average(
+                    [averages[name] for _, averages in results], weights=weights
+                ),
+            )
+        return np.concatenate([rewards for rewards, _ in results])
+
+    def shutdown(self):
+        self.pool.shutdown()
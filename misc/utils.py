@@ -3,6 +3,7 @@ from __future__ import division
 from __future__ import print_function
 
 import collections
+import math
 import torch
 import torch.nn as nn
 import numpy as np
@@ -94,6 +95,32 @@ def decode_sequence(ix_to_word, seq):
     return out
 
 
+def repeat_tensors(n, x):
+    """
+    For a tensor of size Bx..., we repeat it n times, and make it Bnx...
+    For collections, do nested repeat
+    """
+    if torch.is_tensor(x):
+        x = x.unsqueeze(1)  # Bx1x...
+        x = x.expand(-1, n, *([-1] * len(x.shape[2:])))  # Bxnx...
+        x = x.reshape(x.shape[0] * n, *x.shape[2:])  # Bnx...
+    elif type(x) is list or type(x) is tuple:
+        x = [repeat_tensors(n, _) for _ in x]
+    return x
+
+
+def select_tensors(x, index, dim=0):
+    """
+    Select the entries index along dim of a tensor
+    For collections, do nested select
+    """
+    if torch.is_tensor(x):
+        x = x.index_select(dim, index)
+    elif type(x) is list or type(x) is tuple:
+        x = [select_tensors(_, index, dim) for _ in x]
+    return x
+
+
 def to_contiguous(tensor):
     if tensor.is_contiguous():
         return tensor
@@ -123,14 +150,19 @@ class LanguageModelCriterion(nn.Module):
         super(LanguageModelCriterion, self).__init__()
 
     def forward(self, input, target, mask):
+        return self.sum_loss(input, target, mask) / torch.sum(mask[:, : input.size(1)])
+
+    def sum_loss(self, input, target, mask):
+        """
+        The loss summed instead of averaged over the words, so that it can be
+        computed a few steps at a time
+        """
         # truncate to the same size
         target = target[:, : input.size(1)]
         mask = mask[:, : input.size(1)]
 
         output = -input.gather(2, target.unsqueeze(2)).squeeze(2) * mask
-        output = torch.sum(output) / torch.sum(mask)
-
-        return output
+        return torch.sum(output)
 
 
 class LabelSmoothing(nn.Module):
@@ -146,6 +178,9 @@ class LabelSmoothing(nn.Module):
         self.true_dist = None
 
     def forward(self, input, target, mask):
+        return self.sum_loss(input, target, mask) / mask[:, : input.size(1)].sum()
+
+    def sum_loss(self, input, target, mask):
         # truncate to the same size
         target = target[:, : input.size(1)]
         mask = mask[:, : input.size(1)]
@@ -164,7 +199,45 @@ class LabelSmoothing(nn.Module):
         # true_dist[:, self.padding_idx] = 0
         # mask = torch.nonzero(target.data == self.padding_idx)
         # self.true_dist = true_dist
-        return (self.criterion(input, true_dist).sum(1) * mask).sum() / mask.sum()
+        return (self.criterion(input, true_dist).sum(1) * mask).sum()
+
+
+class ClosedFormLabelSmoothing(nn.Module):
+    """
+    Same loss as LabelSmoothing without materializing the smoothed target
+    distribution: with eps = smoothing / (V - 1), the KL divergence of a row is
+    conf * log(conf) + (V - 1) * eps * log(eps) - conf * input[target]
+    - eps * (sum(input) - input[target]).
+    """
+
+    def __init__(self, smoothing=0.0):
+        super(ClosedFormLabelSmoothing, self).__init__()
+        self.confidence = 1.0 - smoothing
+        self.smoothing = smoothing
+
+    def forward(self, input, target, mask):
+        return self.sum_loss(input, target, mask) / mask[:, : input.size(1)].sum()
+
+    def sum_loss(self, input, target, mask):
+        # truncate to the same size
+        target = target[:, : input.size(1)]
+        mask = mask[:, : input.size(1)]
+
+        size = input.size(-1)
+        eps = self.smoothing / (size - 1)
+        # sum of true_dist * log(true_dist), 0 * log(0) = 0
+        entropy = sum(
+            n * p * math.log(p)
+            for n, p in [(1, self.confidence), (size - 1, eps)]
+            if p > 0
+        )
+        target_logprobs = input.gather(2, target.unsqueeze(2)).squeeze(2)
+        output = (
+            entropy
+            - self.confidence * target_logprobs
+            - eps * (input.sum(2) - target_logprobs)
+        )
+        return (output * mask).sum()
 
 
 def set_lr(optimizer, lr):
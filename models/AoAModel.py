@@ -82,7 +82,9 @@ class MultiHeadedDotAttention(nn.Module):
         single_query = 0
         if len(query.size()) == 2:
             single_query = 1
-            query = query.unsqueeze(1)
+            # the key and value may be given once for several consecutive queries
+            # (the beams of an image), these are then attended as one sequence
+            query = query.view(key.size(0), -1, query.size(-1))
 
         nbatches = query.size(0)
 
@@ -95,8 +97,15 @@ class MultiHeadedDotAttention(nn.Module):
                 .view(nbatches, -1, self.h, self.d_k)
                 .transpose(1, 2)
             )
-            key_ = key.view(nbatches, -1, self.h, self.d_k).transpose(1, 2)
-            value_ = value.view(nbatches, -1, self.h, self.d_k).transpose(1, 2)
+            # the key and value may already be split into heads, nbatches x h x * x d_k
+            key_, value_ = [
+                (
+                    x
+                    if x.dim() == 4
+                    else x.view(nbatches, -1, self.h, self.d_k).transpose(1, 2)
+                )
+                for x in (key, value)
+            ]
         else:
             query_, key_, value_ = [
                 l(x).view(nbatches, -1, self.h, self.d_k).transpose(1, 2)
@@ -115,8 +124,8 @@ class MultiHeadedDotAttention(nn.Module):
         x = self.output_layer(x)
 
         if single_query:
-            query = query.squeeze(1)
-            x = x.squeeze(1)
+            query = query.view(-1, query.size(-1))
+            x = x.view(-1, x.size(-1))
         return x
 
 
@@ -164,6 +173,8 @@ class AoA_Refiner_Core(nn.Module):
 
 
 class AoA_Decoder_Core(nn.Module):
+    broadcast_memory = True
+
     def __init__(self, opt):
         super(AoA_Decoder_Core, self).__init__()
         self.drop_prob_lm = opt.drop_prob_lm
@@ -228,16 +239,8 @@ class AoA_Decoder_Core(nn.Module):
         )
 
         if self.use_multi_head == 2:
-            att = self.attention(
-                h_att,
-                p_att_feats.narrow(2, 0, self.multi_head_scale * self.d_model),
-                p_att_feats.narrow(
-                    2,
-                    self.multi_head_scale * self.d_model,
-                    self.multi_head_scale * self.d_model,
-                ),
-                att_masks,
-            )
+            # p_att_feats holds the value and the key, split into heads
+            att = self.attention(h_att, p_att_feats[:, 0], p_att_feats[:, 1], att_masks)
         else:
             att = self.attention(h_att, att_feats, p_att_feats, att_masks)
 
@@ -262,6 +265,7 @@ class AoAModel(AttModel):
     def __init__(self, opt):
         super(AoAModel, self).__init__(opt)
         self.num_layers = 2
+        self.use_multi_head = opt.use_multi_head
         # mean pooling
         self.use_mean_feats = getattr(opt, "mean_feats", 1)
         if opt.use_multi_head == 2:
@@ -298,5 +302,19 @@ class AoAModel(AttModel):
 
         # Project the attention feats first to reduce memory and computation.
         p_att_feats = self.ctx2att(att_feats)
+        if self.use_multi_head == 2:
+            # split the value and the key into the heads of the decoder attention
+            # once for all the steps: batch x 2 x h x att_size x d_k
+            p_att_feats = (
+                p_att_feats.view(
+                    p_att_feats.size(0),
+                    p_att_feats.size(1),
+                    2,
+                    self.core.attention.h,
+                    self.core.attention.d_k,
+                )
+                .permute(0, 2, 3, 1, 4)
+                .contiguous()
+            )
 
         return mean_feats, att_feats, p_att_feats, att_masks
@@ -39,6 +39,9 @@ class AttEnsemble(AttModel):
         self.ss_prob = 0
         weights = weights or [1.0] * len(self.models)
         self.register_buffer("weights", torch.tensor(weights))
+        # (indices, logit weight, logit bias) of each member, restricted to the
+        # union of the members' shortlists, set by _sample and _sample_beam
+        self.vocab_shortlist = None
 
     def init_hidden(self, batch_size):
         state = [m.init_hidden(batch_size) for m in self.models]
@@ -55,6 +58,9 @@ class AttEnsemble(AttModel):
             state = state[l:]
         return out
 
+    def memory_broadcasts(self):
+        return all(m.memory_broadcasts() for m in self.models)
+
     def embed(self, it):
         return [m.embed(it) for m in self.models]
 
@@ -73,10 +79,7 @@ class AttEnsemble(AttModel):
         )
         logprobs = (
             torch.stack(
-                [
-                    F.softmax(m.logit(output[i]), dim=1)
-                    for i, m in enumerate(self.models)
-                ],
+                [self.member_probs(i, m, output[i]) for i, m in enumerate(self.models)],
                 2,
             )
             .mul(self.weights)
@@ -87,6 +90,37 @@ class AttEnsemble(AttModel):
 
         return logprobs, self.pack_state(state)
 
+    def get_shortlist(self, att_feats, att_masks, opt):
+        """
+        The vocab_shortlist of each member: the union of the vocab_shortlist of
+        the members with a shortlist predictor, applied to every member so that
+        their probabilities are mixed over the same words. None if no member
+        has a predictor or no shortlist is asked.
+        """
+        shortlists = [m.get_shortlist(att_feats, att_masks, opt) for m in self.models]
+        shortlists = [shortlist for shortlist in shortlists if shortlist is not None]
+        if not shortlists:
+            return None
+        ix = torch.cat([shortlist[0] for shortlist in shortlists]).unique()
+        return [
+            (ix, logit.weight[ix], logit.bias[ix])
+            for _, logit in (m.split_logit() for m in self.models)
+        ]
+
+    def member_probs(self, i, m, output):
+        """
+        softmax(logit(output)) of the i-th member m, restricted to its
+        vocab_shortlist if there is one, the other words get 0
+        """
+        if self.vocab_shortlist is None:
+            return F.softmax(m.logit(output), dim=1)
+        ix, weight, bias = self.vocab_shortlist[i]
+        hidden, _ = m.split_logit()
+        probs = F.softmax(F.linear(hidden(output), weight, bias), dim=1)
+        return probs.new_zeros(probs.size(0), self.vocab_size + 1).index_copy_(
+            1, ix, probs
+        )
+
     def _prepare_feature(self, *args):
         return tuple(zip(*[m._prepare_feature(*args) for m in self.models]))
 
@@ -103,13 +137,16 @@ class AttEnsemble(AttModel):
 
     #     return fc_feats, att_feats, p_att_feats, [att_masks] * len(self.models)
 
-    def _sample_beam(self, fc_feats, att_feats, att_masks=None, opt={}):
+    def _sample_beam(
+        self, fc_feats, att_feats, att_masks=None, opt={}, prepared_feats=None
+    ):
         beam_size = opt.get("beam_size", 10)
         batch_size = fc_feats.size(0)
+        self.vocab_shortlist = self.get_shortlist(att_feats, att_masks, opt)
 
-        fc_feats, att_feats, p_att_feats, att_masks = self._prepare_feature(
-            fc_feats, att_feats, att_masks
-        )
+        if prepared_feats is None:
+            prepared_feats = self._prepare_feature(fc_feats, att_feats, att_masks)
+        fc_feats, att_feats, p_att_feats, att_masks = prepared_feats
 
         assert beam_size <= self.vocab_size + 1, (
             "lets assume this for now, otherwise this corner case causes a few headaches down the road. can be dealt"
@@ -117,8 +154,39 @@ class AttEnsemble(AttModel):
         )
         seq = torch.LongTensor(self.seq_length, batch_size).zero_()
         seqLogprobs = torch.FloatTensor(self.seq_length, batch_size)
-        # lets process every image independently for now, for simplicity
 
+        if opt.get("group_size", 1) == 1 and opt.get("batched_beam", 1):
+            # decode the beams of all the images at once
+            state = self.init_hidden(batch_size * beam_size)
+            tmp_fc_feats = utils.repeat_tensors(beam_size, fc_feats)
+            tmp_att_feats, tmp_p_att_feats, tmp_att_masks = (
+                [att_feats, p_att_feats, att_masks]
+                if self.memory_broadcasts()
+                else utils.repeat_tensors(
+                    beam_size, [att_feats, p_att_feats, att_masks]
+                )
+            )
+            it = fc_feats[0].data.new(batch_size * beam_size).long().zero_()
+            logprobs, state = self.get_logprobs_state(
+                it, tmp_fc_feats, tmp_att_feats, tmp_p_att_feats, tmp_att_masks, state
+            )
+            self.done_beams = self.batch_beam_search(
+                state,
+                logprobs,
+                tmp_fc_feats,
+                tmp_att_feats,
+                tmp_p_att_feats,
+                tmp_att_masks,
+                opt=opt,
+            )
+            for k in range(batch_size):
+                seq[:, k] = self.done_beams[k][0][
+                    "seq"
+                ]  # the first beam has highest cumulative score
+                seqLogprobs[:, k] = self.done_beams[k][0]["logps"]
+            return seq.transpose(0, 1), seqLogprobs.transpose(0, 1)
+
+        # lets process every image independently for now, for simplicity
         self.done_beams = [[] for _ in range(batch_size)]
         for k in range(batch_size):
             state = self.init_hidden(beam_size)
@@ -126,28 +194,22 @@ class AttEnsemble(AttModel):
                 fc_feats[i][k : k + 1].expand(beam_size, fc_feats[i].size(1))
                 for i, m in enumerate(self.models)
             ]
-            tmp_att_feats = [
-                att_feats[i][k : k + 1]
-                .expand(*((beam_size,) + att_feats[i].size()[1:]))
-                .contiguous()
-                for i, m in enumerate(self.models)
-            ]
-            tmp_p_att_feats = [
-                p_att_feats[i][k : k + 1]
-                .expand(*((beam_size,) + p_att_feats[i].size()[1:]))
-                .contiguous()
-                for i, m in enumerate(self.models)
-            ]
-            tmp_att_masks = [
-                (
-                    att_masks[i][k : k + 1]
-                    .expand(*((beam_size,) + att_masks[i].size()[1:]))
-                    .contiguous()
-                    if att_masks[i] is not None
-                    else att_masks[i]
-                )
-                for i, m in enumerate(self.models)
+            tmp_att_feats, tmp_p_att_feats, tmp_att_masks = [
+                [_[i][k : k + 1] if _[i] is not None else None for i in range(len(_))]
+                for _ in [att_feats, p_att_feats, att_masks]
             ]
+            if not self.memory_broadcasts():
+                tmp_att_feats, tmp_p_att_feats, tmp_att_masks = [
+                    [
+                        (
+                            x.expand(*((beam_size,) + x.size()[1:])).contiguous()
+                            if x is not None
+                            else None
+                        )
+                        for x in _
+                    ]
+                    for _ in [tmp_att_feats, tmp_p_att_feats, tmp_att_masks]
+                ]
 
             it = fc_feats[0].data.new(beam_size).long().zero_()
             logprobs, state = self.get_logprobs_state(
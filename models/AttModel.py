@@ -21,6 +21,7 @@ import numpy as np
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
+from torch.utils.checkpoint import checkpoint
 import misc.utils as utils
 from torch.nn.utils.rnn import PackedSequence, pack_padded_sequence, pad_packed_sequence
 
@@ -132,6 +133,14 @@ class AttModel(CaptionModel):
             )
         self.ctx2att = nn.Linear(self.rnn_size, self.att_hid_size)
 
+        if getattr(opt, "shortlist_predictor", 0):
+            # predicts the words of the captions from the mean attention feature,
+            # to restrict the output projection to a shortlist when sampling
+            self.shortlist = nn.Linear(self.att_feat_size, self.vocab_size + 1)
+        # (indices, logit weight, logit bias) of the shortlist of the batch being
+        # sampled, set by _sample and _sample_beam
+        self.vocab_shortlist = None
+
         # For remove bad endding
         self.vocab = opt.vocab
         self.bad_endings_ix = [
@@ -165,11 +174,85 @@ class AttModel(CaptionModel):
 
         return fc_feats, att_feats, p_att_feats, att_masks
 
-    def _forward(self, fc_feats, att_feats, seq, att_masks=None):
-        batch_size = fc_feats.size(0)
+    def memory_broadcasts(self):
+        """
+        Whether the core accepts att_feats, p_att_feats and att_masks with one row
+        per image while the state has several (the beams), so that beam search
+        doesn't need a copy of them per beam
+        """
+        return getattr(self.core, "broadcast_memory", False)
+
+    def split_logit(self):
+        """
+        The layers of logit before its last Linear, and that Linear
+        """
+        if isinstance(self.logit, nn.Sequential):
+            return self.logit[:-1], self.logit[-1]
+        return (lambda x: x), self.logit
+
+    def shortlist_feats(self, att_feats, att_masks):
+        # mean of the attention features, the input of the shortlist predictor
+        if att_masks is None:
+            return att_feats.mean(1)
+        att_masks = att_masks.unsqueeze(-1).type_as(att_feats)
+        return (att_feats * att_masks).sum(1) / att_masks.sum(1)
+
+    def _shortlist_loss(self, att_feats, att_masks, labels):
+        """
+        Binary cross entropy of the shortlist predictor, the words of the
+        captions of each feature row are its targets
+        """
+        target = att_feats.new_zeros(att_feats.size(0), self.vocab_size + 1)
+        target.scatter_(1, labels.view(att_feats.size(0), -1), 1)
+        return F.binary_cross_entropy_with_logits(
+            self.shortlist(self.shortlist_feats(att_feats, att_masks)), target
+        )
+
+    def get_shortlist(self, att_feats, att_masks, opt):
+        """
+        The vocab_shortlist of the batch: the union of the vocab_shortlist
+        (from opt) most likely words of each image according to the predictor,
+        and <eos>. None if there is no predictor or no shortlist is asked.
+        """
+        shortlist_size = opt.get("vocab_shortlist", 0)
+        if not shortlist_size or not hasattr(self, "shortlist"):
+            return None
+        scores = self.shortlist(self.shortlist_feats(att_feats, att_masks))
+        ix = scores.topk(min(shortlist_size, scores.size(1)), dim=1)[1].view(-1)
+        ix = torch.cat([ix.new_zeros(1), ix]).unique()
+        _, logit = self.split_logit()
+        return ix, logit.weight[ix], logit.bias[ix]
+
+    def shortlist_logprobs(self, output):
+        """
+        log_softmax(logit(output)) restricted to vocab_shortlist, the other words
+        get -inf
+        """
+        ix, weight, bias = self.vocab_shortlist
+        hidden, _ = self.split_logit()
+        logprobs = F.log_softmax(F.linear(hidden(output), weight, bias), dim=1)
+        return logprobs.new_full(
+            (logprobs.size(0), self.vocab_size + 1), float("-inf")
+        ).index_copy_(1, ix, logprobs)
+
+    def _forward(self, fc_feats, att_feats, seq, att_masks=None, crit=None, masks=None):
+        """
+        Returns the log probs of seq, or, if crit is given, the loss crit gives to
+        seq with the masks: it is computed step by step with chunk_loss, without
+        storing the batch x seq_len x vocab log probs.
+        """
+        self.vocab_shortlist = None
+        batch_size = seq.size(0)
+        # the features may be given once per image instead of once per caption
+        seq_per_img = batch_size // fc_feats.size(0)
         state = self.init_hidden(batch_size)
 
-        outputs = fc_feats.new_zeros(batch_size, seq.size(1) - 1, self.vocab_size + 1)
+        if crit is None:
+            outputs = fc_feats.new_zeros(
+                batch_size, seq.size(1) - 1, self.vocab_size + 1
+            )
+        else:
+            loss = fc_feats.new_zeros(())
 
         # Prepare the features
         p_fc_feats, p_att_feats, pp_att_feats, p_att_masks = self._prepare_feature(
@@ -177,6 +260,11 @@ class AttModel(CaptionModel):
         )
         # pp_att_feats is used for attention, we cache it in advance to reduce computation cost
 
+        if seq_per_img > 1:
+            p_fc_feats, p_att_feats, pp_att_feats, p_att_masks = utils.repeat_tensors(
+                seq_per_img, [p_fc_feats, p_att_feats, pp_att_feats, p_att_masks]
+            )
+
         for i in range(seq.size(1) - 1):
             if (
                 self.training and i >= 1 and self.ss_prob > 0.0
@@ -192,7 +280,7 @@ class AttModel(CaptionModel):
                     # it.index_copy_(0, sample_ind, torch.multinomial(prob_prev, 1).view(-1))
                     # prob_prev = torch.exp(outputs[-1].data) # fetch prev distribution: shape Nx(M+1)
                     prob_prev = torch.exp(
-                        outputs[:, i - 1].detach()
+                        output.detach()
                     )  # fetch prev distribution: shape Nx(M+1)
                     it.index_copy_(
                         0,
@@ -207,11 +295,32 @@ class AttModel(CaptionModel):
             if i >= 1 and seq[:, i].sum() == 0:
                 break
 
-            output, state = self.get_logprobs_state(
-                it, p_fc_feats, p_att_feats, pp_att_feats, p_att_masks, state
-            )
-            outputs[:, i] = output
+            if crit is None:
+                output, state = self.get_logprobs_state(
+                    it, p_fc_feats, p_att_feats, pp_att_feats, p_att_masks, state
+                )
+                outputs[:, i] = output
+            else:
+                output, state = self.core(
+                    self.embed(it),
+                    p_fc_feats,
+                    p_att_feats,
+                    pp_att_feats,
+                    state,
+                    p_att_masks,
+                )
+                step_loss, output = checkpoint(
+                    self.chunk_loss,
+                    output.unsqueeze(1),
+                    seq[:, i + 1 : i + 2],
+                    masks[:, i + 1 : i + 2],
+                    crit,
+                    use_reentrant=False,
+                )
+                loss = loss + step_loss
 
+        if crit is not None:
+            return loss / masks[:, 1:].sum()
         return outputs
 
     def get_logprobs_state(
@@ -223,17 +332,23 @@ class AttModel(CaptionModel):
         output, state = self.core(
             xt, fc_feats, att_feats, p_att_feats, state, att_masks
         )
-        logprobs = F.log_softmax(self.logit(output), dim=1)
+        if self.vocab_shortlist is not None:
+            logprobs = self.shortlist_logprobs(output)
+        else:
+            logprobs = F.log_softmax(self.logit(output), dim=1)
 
         return logprobs, state
 
-    def _sample_beam(self, fc_feats, att_feats, att_masks=None, opt={}):
+    def _sample_beam(
+        self, fc_feats, att_feats, att_masks=None, opt={}, prepared_feats=None
+    ):
         beam_size = opt.get("beam_size", 10)
         batch_size = fc_feats.size(0)
+        self.vocab_shortlist = self.get_shortlist(att_feats, att_masks, opt)
 
-        p_fc_feats, p_att_feats, pp_att_feats, p_att_masks = self._prepare_feature(
-            fc_feats, att_feats, att_masks
-        )
+        if prepared_feats is None:
+            prepared_feats = self._prepare_feature(fc_feats, att_feats, att_masks)
+        p_fc_feats, p_att_feats, pp_att_feats, p_att_masks = prepared_feats
 
         assert beam_size <= self.vocab_size + 1, (
             "lets assume this for now, otherwise this corner case causes a few headaches down the road. can be dealt"
@@ -241,29 +356,55 @@ class AttModel(CaptionModel):
         )
         seq = torch.LongTensor(self.seq_length, batch_size).zero_()
         seqLogprobs = torch.FloatTensor(self.seq_length, batch_size)
-        # lets process every image independently for now, for simplicity
 
+        if opt.get("group_size", 1) == 1 and opt.get("batched_beam", 1):
+            # decode the beams of all the images at once
+            state = self.init_hidden(batch_size * beam_size)
+            tmp_fc_feats = utils.repeat_tensors(beam_size, p_fc_feats)
+            tmp_att_feats, tmp_p_att_feats, tmp_att_masks = (
+                [p_att_feats, pp_att_feats, p_att_masks]
+                if self.memory_broadcasts()
+                else utils.repeat_tensors(
+                    beam_size, [p_att_feats, pp_att_feats, p_att_masks]
+                )
+            )
+            it = fc_feats.new_zeros([batch_size * beam_size], dtype=torch.long)
+            logprobs, state = self.get_logprobs_state(
+                it, tmp_fc_feats, tmp_att_feats, tmp_p_att_feats, tmp_att_masks, state
+            )
+            self.done_beams = self.batch_beam_search(
+                state,
+                logprobs,
+                tmp_fc_feats,
+                tmp_att_feats,
+                tmp_p_att_feats,
+                tmp_att_masks,
+                opt=opt,
+            )
+            for k in range(batch_size):
+                seq[:, k] = self.done_beams[k][0][
+                    "seq"
+                ]  # the first beam has highest cumulative score
+                seqLogprobs[:, k] = self.done_beams[k][0]["logps"]
+            return seq.transpose(0, 1), seqLogprobs.transpose(0, 1)
+
+        # lets process every image independently for now, for simplicity
         self.done_beams = [[] for _ in range(batch_size)]
         for k in range(batch_size):
             state = self.init_hidden(beam_size)
             tmp_fc_feats = p_fc_feats[k : k + 1].expand(beam_size, p_fc_feats.size(1))
-            tmp_att_feats = (
-                p_att_feats[k : k + 1]
-                .expand(*((beam_size,) + p_att_feats.size()[1:]))
-                .contiguous()
-            )
-            tmp_p_att_feats = (
-                pp_att_feats[k : k + 1]
-                .expand(*((beam_size,) + pp_att_feats.size()[1:]))
-                .contiguous()
-            )
-            tmp_att_masks = (
-                p_att_masks[k : k + 1]
-                .expand(*((beam_size,) + p_att_masks.size()[1:]))
-                .contiguous()
-                if att_masks is not None
-                else None
-            )
+            tmp_att_feats = p_att_feats[k : k + 1]
+            tmp_p_att_feats = pp_att_feats[k : k + 1]
+            tmp_att_masks = p_att_masks[k : k + 1] if att_masks is not None else None
+            if not self.memory_broadcasts():
+                tmp_att_feats, tmp_p_att_feats, tmp_att_masks = [
+                    (
+                        _.expand(*((beam_size,) + _.size()[1:])).contiguous()
+                        if _ is not None
+                        else None
+                    )
+                    for _ in [tmp_att_feats, tmp_p_att_feats, tmp_att_masks]
+                ]
 
             for t in range(1):
                 if t == 0:  # input <bos>
@@ -294,27 +435,36 @@ class AttModel(CaptionModel):
         # return the samples and their log likelihoods
         return seq.transpose(0, 1), seqLogprobs.transpose(0, 1)
 
-    def _sample(self, fc_feats, att_feats, att_masks=None, opt={}):
+    def _sample(self, fc_feats, att_feats, att_masks=None, opt={}, prepared_feats=None):
+        """
+        prepared_feats, if given, is the output of _prepare_feature for these
+        features, so that several decodes can share one encoder pass.
+        """
         sample_method = opt.get("sample_method", "greedy")
         beam_size = opt.get("beam_size", 1)
         temperature = opt.get("temperature", 1.0)
         decoding_constraint = opt.get("decoding_constraint", 0)
         block_trigrams = opt.get("block_trigrams", 0)
         remove_bad_endings = opt.get("remove_bad_endings", 0)
+        compact_finished = opt.get("compact_finished", 0)
         if beam_size > 1:
-            return self._sample_beam(fc_feats, att_feats, att_masks, opt)
+            return self._sample_beam(
+                fc_feats, att_feats, att_masks, opt, prepared_feats=prepared_feats
+            )
 
         batch_size = fc_feats.size(0)
         state = self.init_hidden(batch_size)
+        self.vocab_shortlist = self.get_shortlist(att_feats, att_masks, opt)
 
-        p_fc_feats, p_att_feats, pp_att_feats, p_att_masks = self._prepare_feature(
-            fc_feats, att_feats, att_masks
-        )
-
-        trigrams = []  # will be a list of batch_size dictionaries
+        if prepared_feats is None:
+            prepared_feats = self._prepare_feature(fc_feats, att_feats, att_masks)
+        p_fc_feats, p_att_feats, pp_att_feats, p_att_masks = prepared_feats
 
         seq = fc_feats.new_zeros((batch_size, self.seq_length), dtype=torch.long)
         seqLogprobs = fc_feats.new_zeros(batch_size, self.seq_length)
+        # rows of seq still being decoded, the finished ones are dropped from
+        # the state and the features when compact_finished
+        active = torch.arange(batch_size, device=seq.device)
         for t in range(self.seq_length + 1):
             if t == 0:  # input <bos>
                 it = fc_feats.new_zeros(batch_size, dtype=torch.long)
@@ -323,58 +473,22 @@ class AttModel(CaptionModel):
                 it, p_fc_feats, p_att_feats, pp_att_feats, p_att_masks, state
             )
 
+            # it is the previous word, seq[active, t - 1]
             if decoding_constraint and t > 0:
                 tmp = logprobs.new_zeros(logprobs.size())
-                tmp.scatter_(1, seq[:, t - 1].data.unsqueeze(1), float("-inf"))
+                tmp.scatter_(1, it.data.unsqueeze(1), float("-inf"))
                 logprobs = logprobs + tmp
 
             if remove_bad_endings and t > 0:
                 tmp = logprobs.new_zeros(logprobs.size())
-                prev_bad = np.isin(
-                    seq[:, t - 1].data.cpu().numpy(), self.bad_endings_ix
-                )
+                prev_bad = np.isin(it.data.cpu().numpy(), self.bad_endings_ix)
                 # Impossible to generate remove_bad_endings
                 tmp[torch.from_numpy(prev_bad.astype("uint8")), 0] = float("-inf")
                 logprobs = logprobs + tmp
 
             # Mess with trigrams
             if block_trigrams and t >= 3:
-                # Store trigram generated at last step
-                prev_two_batch = seq[:, t - 3 : t - 1]
-                for i in range(batch_size):  # = seq.size(0)
-                    prev_two = (
-                        prev_two_batch[i][0].item(),
-                        prev_two_batch[i][1].item(),
-                    )
-                    current = seq[i][t - 1]
-                    if t == 3:  # initialize
-                        trigrams.append(
-                            {prev_two: [current]}
-                        )  # {LongTensor: list containing 1 int}
-                    elif t > 3:
-                        if prev_two in trigrams[i]:  # add to list
-                            trigrams[i][prev_two].append(current)
-                        else:  # create list
-                            trigrams[i][prev_two] = [current]
-                # Block used trigrams at next step
-                prev_two_batch = seq[:, t - 2 : t]
-                mask = torch.zeros(
-                    logprobs.size(), requires_grad=False
-                ).cuda()  # batch_size x vocab_size
-                for i in range(batch_size):
-                    prev_two = (
-                        prev_two_batch[i][0].item(),
-                        prev_two_batch[i][1].item(),
-                    )
-                    if prev_two in trigrams[i]:
-                        for j in trigrams[i][prev_two]:
-                            mask[i, j] += 1
-                # Apply mask to log probs
-                # logprobs = logprobs - (mask * 1e9)
-                alpha = 2.0  # = 4
-                logprobs = logprobs + (
-                    mask * -0.693 * alpha
-                )  # ln(1/2) * alpha (alpha -> infty works best)
+                logprobs = self.penalize_trigrams(seq[active, :t], logprobs)
 
             # sample the next word
             if t == self.seq_length:  # skip if we achieve maximum length
@@ -389,11 +503,21 @@ class AttModel(CaptionModel):
             else:
                 unfinished = unfinished * (it > 0)
             it = it * unfinished.type_as(it)
-            seq[:, t] = it
-            seqLogprobs[:, t] = sampleLogprobs.view(-1)
+            seq[active, t] = it
+            seqLogprobs[active, t] = sampleLogprobs.view(-1)
             # quit loop if all sequences have finished
             if unfinished.sum() == 0:
                 break
+            if compact_finished and not unfinished.all():
+                # drop the rows that have just finished
+                keep = unfinished.nonzero().view(-1)
+                active, it, unfinished = active[keep], it[keep], unfinished[keep]
+                state = utils.select_tensors(state, keep, 1)
+                p_fc_feats, p_att_feats, pp_att_feats, p_att_masks = (
+                    utils.select_tensors(
+                        [p_fc_feats, p_att_feats, pp_att_feats, p_att_masks], keep
+                    )
+                )
 
         return seq, seqLogprobs
 
@@ -593,6 +717,8 @@ class AdaAttCore(nn.Module):
 
 
 class TopDownCore(nn.Module):
+    broadcast_memory = True
+
     def __init__(self, opt, use_maxout=False):
         super(TopDownCore, self).__init__()
         self.drop_prob_lm = opt.drop_prob_lm
@@ -632,6 +758,8 @@ from .FCModel import LSTMCore
 
 
 class StackAttCore(nn.Module):
+    broadcast_memory = True
+
     def __init__(self, opt, use_maxout=False):
         super(StackAttCore, self).__init__()
         self.drop_prob_lm = opt.drop_prob_lm
@@ -671,6 +799,8 @@ class StackAttCore(nn.Module):
 
 
 class DenseAttCore(nn.Module):
+    broadcast_memory = True
+
     def __init__(self, opt, use_maxout=False):
         super(DenseAttCore, self).__init__()
         self.drop_prob_lm = opt.drop_prob_lm
@@ -737,31 +867,35 @@ class Attention(nn.Module):
     def forward(self, h, att_feats, p_att_feats, att_masks=None):
         # The p_att_feats here is already projected
         att_size = att_feats.numel() // att_feats.size(0) // att_feats.size(-1)
-        att = p_att_feats.view(-1, att_size, self.att_hid_size)
+        # the features may be given once for several consecutive rows of h (the
+        # beams of an image), they are broadcast instead of copied
+        mem_size = att_feats.size(0)
+        att = p_att_feats.view(mem_size, 1, att_size, self.att_hid_size)
 
         att_h = self.h2att(h)  # batch * att_hid_size
-        att_h = att_h.unsqueeze(1).expand_as(att)  # batch * att_size * att_hid_size
-        dot = att + att_h  # batch * att_size * att_hid_size
-        dot = torch.tanh(dot)  # batch * att_size * att_hid_size
-        dot = dot.view(-1, self.att_hid_size)  # (batch * att_size) * att_hid_size
-        dot = self.alpha_net(dot)  # (batch * att_size) * 1
-        dot = dot.view(-1, att_size)  # batch * att_size
-
-        weight = F.softmax(dot, dim=1)  # batch * att_size
+        att_h = att_h.view(mem_size, -1, 1, self.att_hid_size)
+        dot = att + att_h  # mem_size * (batch / mem_size) * att_size * att_hid_size
+        dot = torch.tanh(dot)
+        dot = self.alpha_net(dot)  # mem_size * (batch / mem_size) * att_size * 1
+        dot = dot.view(mem_size, -1, att_size)
+
+        weight = F.softmax(dot, dim=2)
         if att_masks is not None:
-            weight = weight * att_masks.view(-1, att_size).float()
-            weight = weight / weight.sum(1, keepdim=True)  # normalize to 1
+            weight = weight * att_masks.view(mem_size, 1, att_size).float()
+            weight = weight / weight.sum(2, keepdim=True)  # normalize to 1
         att_feats_ = att_feats.view(
-            -1, att_size, att_feats.size(-1)
-        )  # batch * att_size * att_feat_size
-        att_res = torch.bmm(weight.unsqueeze(1), att_feats_).squeeze(
-            1
+            mem_size, att_size, att_feats.size(-1)
+        )  # mem_size * att_size * att_feat_size
+        att_res = torch.bmm(weight, att_feats_).view(
+            -1, att_feats.size(-1)
         )  # batch * att_feat_size
 
         return att_res
 
 
 class Att2in2Core(nn.Module):
+    broadcast_memory = True
+
     def __init__(self, opt):
         super(Att2in2Core, self).__init__()
         self.input_encoding_size = opt.input_encoding_size
@@ -820,6 +954,8 @@ However, this is not a correct replication actually. Will fix it.
 
 
 class Att2all2Core(nn.Module):
+    broadcast_memory = True
+
     def __init__(self, opt):
         super(Att2all2Core, self).__init__()
         self.input_encoding_size = opt.input_encoding_size
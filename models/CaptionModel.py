@@ -9,7 +9,6 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
-import numpy as np
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
@@ -73,51 +72,39 @@ class CaptionModel(nn.Module):
             # beam_logprobs_sum : joint log-probability of each beam
 
             ys, ix = torch.sort(logprobsf, 1, True)
-            candidates = []
             cols = min(beam_size, ys.size(1))
             rows = beam_size
             if t == 0:
                 rows = 1
-            for c in range(cols):  # for each column (word, essentially)
-                for q in range(rows):  # for each beam expansion
-                    # compute logprob of expanding beam q with word in (sorted) position c
-                    local_logprob = ys[q, c].item()
-                    candidate_logprob = beam_logprobs_sum[q] + local_logprob
-                    local_unaug_logprob = unaug_logprobsf[q, ix[q, c]]
-                    candidates.append(
-                        {
-                            "c": ix[q, c],
-                            "q": q,
-                            "p": candidate_logprob,
-                            "r": local_unaug_logprob,
-                        }
-                    )
-            candidates = sorted(candidates, key=lambda x: -x["p"])
+            ys = ys[:rows, :cols]
+            ix = ix[:rows, :cols]
+            # logprob of expanding beam q with word in (sorted) position c. The
+            # candidates are listed c-major and sorted stably, so that ties are
+            # broken by (c, q) order
+            candidate_logprobs = (beam_logprobs_sum[:rows].unsqueeze(1) + ys).t()
+            candidate_unaug_logprobs = unaug_logprobsf[:rows].gather(1, ix).t()
+            candidate_logprobs, candidate_ix = torch.sort(
+                candidate_logprobs.reshape(-1), descending=True, stable=True
+            )
+            candidate_ix = candidate_ix[:beam_size]
+            q = candidate_ix % rows  # fork beam index q into index vix
 
-            new_state = [_.clone() for _ in state]
-            # beam_seq_prev, beam_seq_logprobs_prev
             if t >= 1:
-                # we''ll need these as reference when we fork beams around
-                beam_seq_prev = beam_seq[:t].clone()
-                beam_seq_logprobs_prev = beam_seq_logprobs[:t].clone()
-            for vix in range(beam_size):
-                v = candidates[vix]
-                # fork beam index q into index vix
-                if t >= 1:
-                    beam_seq[:t, vix] = beam_seq_prev[:, v["q"]]
-                    beam_seq_logprobs[:t, vix] = beam_seq_logprobs_prev[:, v["q"]]
-                # rearrange recurrent states
-                for state_ix in range(len(new_state)):
-                    #  copy over state in previous beam q to new beam at vix
-                    new_state[state_ix][:, vix] = state[state_ix][
-                        :, v["q"]
-                    ]  # dimension one is time step
-                # append new end terminal at the end of this beam
-                beam_seq[t, vix] = v["c"]  # c'th word is the continuation
-                beam_seq_logprobs[t, vix] = v["r"]  # the raw logprob here
-                beam_logprobs_sum[vix] = v["p"]  # the new (sum) logprob along this beam
-            state = new_state
-            return beam_seq, beam_seq_logprobs, beam_logprobs_sum, state, candidates
+                beam_seq[:t] = beam_seq[:t].index_select(1, q)
+                beam_seq_logprobs[:t] = beam_seq_logprobs[:t].index_select(1, q)
+            # rearrange recurrent states, dimension one is the beam
+            state = [_.index_select(1, q) for _ in state]
+            # append new end terminal at the end of this beam
+            beam_seq[t] = ix.t().reshape(-1)[
+                candidate_ix
+            ]  # c'th word is the continuation
+            beam_seq_logprobs[t] = candidate_unaug_logprobs.reshape(-1)[
+                candidate_ix
+            ]  # the raw logprob here
+            beam_logprobs_sum = candidate_logprobs[
+                :beam_size
+            ].clone()  # the new (sum) logprob along this beam
+            return beam_seq, beam_seq_logprobs, beam_logprobs_sum, state
 
         # Start diverse_beam_search
         opt = kwargs["opt"]
@@ -129,17 +116,30 @@ class CaptionModel(nn.Module):
         diversity_lambda = opt.get("diversity_lambda", 0.5)
         decoding_constraint = opt.get("decoding_constraint", 0)
         remove_bad_endings = opt.get("remove_bad_endings", 0)
+        block_trigrams = opt.get("block_trigrams", 0)
         length_penalty = utils.penalty_builder(opt.get("length_penalty", ""))
         bdash = beam_size // group_size  # beam per group
+        device = init_logprobs.device
 
         # INITIALIZATIONS
+        # the tables stay on the device of the logprobs, the finished beams are
+        # copied to the cpu
         beam_seq_table = [
-            torch.LongTensor(self.seq_length, bdash).zero_() for _ in range(group_size)
+            torch.zeros(self.seq_length, bdash, dtype=torch.long, device=device)
+            for _ in range(group_size)
         ]
         beam_seq_logprobs_table = [
-            torch.FloatTensor(self.seq_length, bdash).zero_() for _ in range(group_size)
+            torch.zeros(self.seq_length, bdash, device=device)
+            for _ in range(group_size)
+        ]
+        beam_logprobs_sum_table = [
+            torch.zeros(bdash, device=device) for _ in range(group_size)
         ]
-        beam_logprobs_sum_table = [torch.zeros(bdash) for _ in range(group_size)]
+        if remove_bad_endings:
+            bad_endings_mask = torch.zeros(
+                init_logprobs.size(1), dtype=torch.bool, device=device
+            )
+            bad_endings_mask[self.bad_endings_ix] = True
 
         # logprobs # logprobs predicted in last time step, shape (beam_size, vocab_size+1)
         done_beams_table = [[] for _ in range(group_size)]
@@ -148,15 +148,17 @@ class CaptionModel(nn.Module):
         logprobs_table = list(init_logprobs.chunk(group_size, 0))
         # END INIT
 
-        # Chunk elements in the args
+        # Chunk elements in the args, the ones with a single row for all the beams
+        # (see AttModel.memory_broadcasts) are shared by the groups
+        def chunk_arg(x):
+            if x is None or x.size(0) != beam_size:
+                return [x] * group_size
+            return x.chunk(group_size)
+
         args = list(args)
         if self.__class__.__name__ == "AttEnsemble":
             args = [
-                [
-                    _.chunk(group_size) if _ is not None else [None] * group_size
-                    for _ in args_
-                ]
-                for args_ in args
+                [chunk_arg(_) for _ in args_] for args_ in args
             ]  # arg_name, model_name, group_name
             args = [
                 [
@@ -166,10 +168,7 @@ class CaptionModel(nn.Module):
                 for k in range(group_size)
             ]  # group_name, arg_name, model_name
         else:
-            args = [
-                _.chunk(group_size) if _ is not None else [None] * group_size
-                for _ in args
-            ]
+            args = [chunk_arg(_) for _ in args]
             args = [[args[i][j] for i in range(len(args))] for j in range(group_size)]
 
         for t in range(self.seq_length + group_size - 1):
@@ -181,23 +180,21 @@ class CaptionModel(nn.Module):
                     if decoding_constraint and t - divm > 0:
                         logprobsf.scatter_(
                             1,
-                            beam_seq_table[divm][t - divm - 1].unsqueeze(1).cuda(),
+                            beam_seq_table[divm][t - divm - 1].unsqueeze(1),
                             float("-inf"),
                         )
                     if remove_bad_endings and t - divm > 0:
                         logprobsf[
-                            torch.from_numpy(
-                                np.isin(
-                                    beam_seq_table[divm][t - divm - 1].cpu().numpy(),
-                                    self.bad_endings_ix,
-                                ).astype("uint8")
-                            ),
-                            0,
+                            bad_endings_mask[beam_seq_table[divm][t - divm - 1]], 0
                         ] = float("-inf")
                     # suppress UNK tokens in the decoding
                     logprobsf[:, logprobsf.size(1) - 1] = (
                         logprobsf[:, logprobsf.size(1) - 1] - 1000
                     )
+                    if block_trigrams and t - divm >= 3:
+                        logprobsf = self.penalize_trigrams(
+                            beam_seq_table[divm][: t - divm].t(), logprobsf
+                        )
                     # diversity is added here
                     # the function directly modifies the logprobsf values and hence, we need to return
                     # the unaugmented ones for sorting the candidates in the end. # for historical
@@ -212,7 +209,6 @@ class CaptionModel(nn.Module):
                         beam_seq_logprobs_table[divm],
                         beam_logprobs_sum_table[divm],
                         state_table[divm],
-                        candidates_divm,
                     ) = beam_step(
                         logprobsf,
                         unaug_logprobsf,
@@ -225,31 +221,33 @@ class CaptionModel(nn.Module):
                     )
 
                     # if time's up... or if end token is reached then copy beams
-                    for vix in range(bdash):
-                        if (
-                            beam_seq_table[divm][t - divm, vix] == 0
-                            or t == self.seq_length + divm - 1
-                        ):
+                    if t == self.seq_length + divm - 1:
+                        is_done = torch.ones(bdash, dtype=torch.bool, device=device)
+                    else:
+                        is_done = beam_seq_table[divm][t - divm] == 0
+                    if is_done.any():
+                        done_seq = beam_seq_table[divm].cpu()
+                        done_logps = beam_seq_logprobs_table[divm].cpu()
+                        done_p = beam_logprobs_sum_table[divm].cpu()
+                        for vix in is_done.nonzero().view(-1).tolist():
                             final_beam = {
-                                "seq": beam_seq_table[divm][:, vix].clone(),
-                                "logps": beam_seq_logprobs_table[divm][:, vix].clone(),
-                                "unaug_p": beam_seq_logprobs_table[divm][:, vix]
-                                .sum()
-                                .item(),
-                                "p": beam_logprobs_sum_table[divm][vix].item(),
+                                "seq": done_seq[:, vix].clone(),
+                                "logps": done_logps[:, vix].clone(),
+                                "unaug_p": done_logps[:, vix].sum().item(),
+                                "p": done_p[vix].item(),
                             }
                             final_beam["p"] = length_penalty(
                                 t - divm + 1, final_beam["p"]
                             )
                             done_beams_table[divm].append(final_beam)
-                            # don't continue beams from finished sequences
-                            beam_logprobs_sum_table[divm][vix] = -1000
+                        # don't continue beams from finished sequences
+                        beam_logprobs_sum_table[divm][is_done] = -1000
 
                     # move the current group one step forward in time
 
                     it = beam_seq_table[divm][t - divm]
                     logprobs_table[divm], state_table[divm] = self.get_logprobs_state(
-                        it.cuda(), *(args[divm] + [state_table[divm]])
+                        it, *(args[divm] + [state_table[divm]])
                     )
                     logprobs_table[divm] = F.log_softmax(
                         logprobs_table[divm] / temperature, dim=-1
@@ -263,6 +261,153 @@ class CaptionModel(nn.Module):
         done_beams = reduce(lambda a, b: a + b, done_beams_table)
         return done_beams
 
+    def batch_beam_search(self, init_state, init_logprobs, *args, **kwargs):
+        # Same as beam_search with group_size 1, but all the images of the batch are
+        # decoded at once. Row b * beam_size + k of the state, logprobs and args is
+        # beam k of image b. Returns a list of done_beams, one per image.
+        opt = kwargs["opt"]
+        temperature = opt.get("temperature", 1)
+        beam_size = opt.get("beam_size", 10)
+        decoding_constraint = opt.get("decoding_constraint", 0)
+        remove_bad_endings = opt.get("remove_bad_endings", 0)
+        block_trigrams = opt.get("block_trigrams", 0)
+        length_penalty = utils.penalty_builder(opt.get("length_penalty", ""))
+
+        # INITIALIZATIONS
+        state = init_state
+        logprobs = init_logprobs
+        device = logprobs.device
+        batch_size = logprobs.size(0) // beam_size
+        cols = min(beam_size, logprobs.size(1))
+        beam_seq = torch.zeros(
+            batch_size, beam_size, self.seq_length, dtype=torch.long, device=device
+        )
+        beam_seq_logprobs = torch.zeros(
+            batch_size, beam_size, self.seq_length, device=device
+        )
+        beam_logprobs_sum = torch.zeros(batch_size, beam_size, device=device)
+        # offset of the first beam of each image in the flattened rows
+        base = torch.arange(batch_size, device=device).unsqueeze(1) * beam_size
+        if remove_bad_endings:
+            bad_endings_mask = torch.zeros(
+                logprobs.size(1), dtype=torch.bool, device=device
+            )
+            bad_endings_mask[self.bad_endings_ix] = True
+        done_beams = [[] for _ in range(batch_size)]
+        # END INIT
+
+        for t in range(self.seq_length):
+            logprobsf = logprobs.data.float()
+            # suppress previous word
+            if decoding_constraint and t > 0:
+                logprobsf.scatter_(
+                    1, beam_seq[:, :, t - 1].reshape(-1, 1), float("-inf")
+                )
+            if remove_bad_endings and t > 0:
+                logprobsf[bad_endings_mask[beam_seq[:, :, t - 1].reshape(-1)], 0] = (
+                    float("-inf")
+                )
+            # suppress UNK tokens in the decoding
+            logprobsf[:, logprobsf.size(1) - 1] = (
+                logprobsf[:, logprobsf.size(1) - 1] - 1000
+            )
+            if block_trigrams and t >= 3:
+                logprobsf = self.penalize_trigrams(
+                    beam_seq[:, :, :t].reshape(-1, t), logprobsf
+                )
+
+            # expand every beam q with its c best words. The candidates are
+            # laid out c-major and sorted stably, so that ties are broken in the
+            # same order as in beam_step
+            ys, ix = torch.sort(logprobsf, 1, True)
+            rows = 1 if t == 0 else beam_size
+            ys = ys.view(batch_size, beam_size, -1)[:, :rows, :cols]
+            ix = ix.view(batch_size, beam_size, -1)[:, :rows, :cols]
+            ys = ys.transpose(1, 2).reshape(batch_size, -1)
+            ix = ix.transpose(1, 2).reshape(batch_size, -1)
+            candidate_logprobs = (
+                beam_logprobs_sum[:, :rows].repeat(1, cols) + ys
+            )  # batch_size x (cols * rows)
+            candidate_logprobs, candidate_ix = torch.sort(
+                candidate_logprobs, dim=1, descending=True, stable=True
+            )
+            candidate_ix = candidate_ix[:, :beam_size]
+            q = candidate_ix % rows  # the beam each new beam is forked from
+
+            # fork the beams and append the new words
+            beam_seq = beam_seq.gather(
+                1, q.unsqueeze(2).expand(-1, -1, self.seq_length)
+            )
+            beam_seq_logprobs = beam_seq_logprobs.gather(
+                1, q.unsqueeze(2).expand(-1, -1, self.seq_length)
+            )
+            beam_seq[:, :, t] = ix.gather(1, candidate_ix)
+            beam_seq_logprobs[:, :, t] = ys.gather(1, candidate_ix)
+            beam_logprobs_sum = candidate_logprobs[:, :beam_size].clone()
+            # rearrange recurrent states, dimension one is the batch
+            state = [_.index_select(1, (base + q).view(-1)) for _ in state]
+
+            # if time's up... or if end token is reached then copy beams
+            if t == self.seq_length - 1:
+                is_done = torch.ones_like(beam_logprobs_sum, dtype=torch.bool)
+            else:
+                is_done = beam_seq[:, :, t] == 0
+            if is_done.any():
+                done_seq = beam_seq.cpu()
+                done_logps = beam_seq_logprobs.cpu()
+                done_p = beam_logprobs_sum.cpu()
+                for k, vix in is_done.nonzero().tolist():
+                    final_beam = {
+                        "seq": done_seq[k, vix].clone(),
+                        "logps": done_logps[k, vix].clone(),
+                        "unaug_p": done_logps[k, vix].sum().item(),
+                        "p": done_p[k, vix].item(),
+                    }
+                    final_beam["p"] = length_penalty(t + 1, final_beam["p"])
+                    done_beams[k].append(final_beam)
+                # don't continue beams from finished sequences
+                beam_logprobs_sum[is_done] = -1000
+
+            # move one step forward in time
+            if t < self.seq_length - 1:
+                it = beam_seq[:, :, t].reshape(-1)
+                logprobs, state = self.get_logprobs_state(it, *(list(args) + [state]))
+                logprobs = F.log_softmax(logprobs / temperature, dim=-1)
+
+        # all beams are sorted by their log-probabilities
+        done_beams = [
+            sorted(done_beams[k], key=lambda x: -x["p"])[:beam_size]
+            for k in range(batch_size)
+        ]
+        return done_beams
+
+    def chunk_loss(self, output, target, mask, crit):
+        """
+        The loss crit.sum_loss gives to the words target of output (batch x steps
+        x rnn_size, the outputs of the core), and the detached log probs of its
+        last step. Meant to run under torch.utils.checkpoint, so that the log
+        probs are recomputed during the backward instead of stored.
+        """
+        logprobs = F.log_softmax(self.logit(output), dim=-1)
+        return crit.sum_loss(logprobs, target, mask), logprobs[:, -1].detach()
+
+    def penalize_trigrams(self, seq, logprobs):
+        """
+        Penalize the words that would repeat a trigram of seq (batch x t, the words
+        generated so far): w is penalized once per occurrence of
+        (seq[:, -2], seq[:, -1], w) in seq.
+        """
+        # trigrams of seq whose first two words are the last two words of seq
+        match = (seq[:, :-2] == seq[:, -2:-1]) & (seq[:, 1:-1] == seq[:, -1:])
+        mask = logprobs.new_zeros(logprobs.size())  # batch_size x vocab_size
+        mask.scatter_add_(1, seq[:, 2:], match.type_as(mask))
+        # Apply mask to log probs
+        # logprobs = logprobs - (mask * 1e9)
+        alpha = 2.0  # = 4
+        return logprobs + (
+            mask * -0.693 * alpha
+        )  # ln(1/2) * alpha (alpha -> infty works best)
+
     def sample_next_word(self, logprobs, sample_method, temperature):
         if sample_method == "greedy":
             sampleLogprobs, it = torch.max(logprobs.data, 1)
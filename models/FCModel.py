@@ -81,7 +81,11 @@ class FCModel(CaptionModel):
             return weight.new_zeros(self.num_layers, bsz, self.rnn_size)
 
     def _forward(self, fc_feats, att_feats, seq, att_masks=None):
-        batch_size = fc_feats.size(0)
+        batch_size = seq.size(0)
+        # the features may be given once per image instead of once per caption
+        seq_per_img = batch_size // fc_feats.size(0)
+        if seq_per_img > 1:
+            fc_feats = utils.repeat_tensors(seq_per_img, fc_feats)
         state = self.init_hidden(batch_size)
         outputs = []
 
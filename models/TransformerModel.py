@@ -14,6 +14,7 @@ from __future__ import print_function
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
+from torch.utils.checkpoint import checkpoint
 import misc.utils as utils
 
 import copy
@@ -53,6 +54,14 @@ class EncoderDecoder(nn.Module):
     def decode(self, memory, src_mask, tgt, tgt_mask):
         return self.decoder(self.tgt_embed(tgt), memory, src_mask, tgt_mask)
 
+    def decode_step(self, memory, src_mask, tgt, state):
+        "Decode the newest tokens tgt given the cached keys and values of the prefix."
+        step = state[0].size(2) if len(state) > 0 else 0
+        embed, position = self.tgt_embed
+        return self.decoder.forward_step(
+            position(embed(tgt), start=step), memory, src_mask, state
+        )
+
 
 class Generator(nn.Module):
     "Define standard linear + softmax generation step."
@@ -145,6 +154,16 @@ class Decoder(nn.Module):
             x = layer(x, memory, src_mask, tgt_mask)
         return self.norm(x)
 
+    def forward_step(self, x, memory, src_mask, state):
+        "Incremental decoding, state holds the keys and values cached by each layer."
+        new_state = []
+        for i, layer in enumerate(self.layers):
+            x, layer_state = layer.forward_step(
+                x, memory, src_mask, state[i] if len(state) > 0 else None
+            )
+            new_state.append(layer_state)
+        return self.norm(x), new_state
+
 
 class DecoderLayer(nn.Module):
     "Decoder is made of self-attn, src-attn, and feed forward (defined below)"
@@ -164,6 +183,14 @@ class DecoderLayer(nn.Module):
         x = self.sublayer[1](x, lambda x: self.src_attn(x, m, m, src_mask))
         return self.sublayer[2](x, self.feed_forward)
 
+    def forward_step(self, x, memory, src_mask, state=None):
+        "Same as forward for the newest position, the previous ones are in state."
+        m = memory
+        attn, state = self.self_attn.forward_step(self.sublayer[0].norm(x), state)
+        x = x + self.sublayer[0].dropout(attn)
+        x = self.sublayer[1](x, lambda x: self.src_attn(x, m, m, src_mask))
+        return self.sublayer[2](x, self.feed_forward), state
+
 
 def subsequent_mask(size):
     "Mask out subsequent positions."
@@ -216,6 +243,28 @@ class MultiHeadedAttention(nn.Module):
         x = x.transpose(1, 2).contiguous().view(nbatches, -1, self.h * self.d_k)
         return self.linears[-1](x)
 
+    def forward_step(self, query, state=None):
+        """
+        Self-attention of the newest position over itself and the previous ones.
+        state (2 x batch x steps x d_model) caches the projected keys and values
+        of the previous positions, it's returned with the newest one appended.
+        """
+        nbatches = query.size(0)
+
+        kv = torch.stack([self.linears[1](query), self.linears[2](query)])
+        if state is not None:
+            kv = torch.cat([state, kv], 2)
+        query = self.linears[0](query).view(nbatches, -1, self.h, self.d_k)
+        key, value = kv.view(2, nbatches, -1, self.h, self.d_k).transpose(2, 3)
+
+        # no mask, the previous positions are all visible
+        x, self.attn = attention(
+            query.transpose(1, 2), key, value, dropout=self.dropout
+        )
+
+        x = x.transpose(1, 2).contiguous().view(nbatches, -1, self.h * self.d_k)
+        return self.linears[-1](x), kv
+
 
 class PositionwiseFeedForward(nn.Module):
     "Implements FFN equation."
@@ -258,8 +307,8 @@ class PositionalEncoding(nn.Module):
         pe = pe.unsqueeze(0)
         self.register_buffer("pe", pe)
 
-    def forward(self, x):
-        x = x + self.pe[:, : x.size(1)]
+    def forward(self, x, start=0):
+        x = x + self.pe[:, start : start + x.size(1)]
         return self.dropout(x)
 
 
@@ -329,6 +378,9 @@ class TransformerModel(AttModel):
     def logit(self, x):  # unsafe way
         return self.model.generator.proj(x)
 
+    def split_logit(self):
+        return (lambda x: x), self.model.generator.proj
+
     def init_hidden(self, bsz):
         return []
 
@@ -362,12 +414,39 @@ class TransformerModel(AttModel):
 
         return att_feats, seq, att_masks, seq_mask
 
-    def _forward(self, fc_feats, att_feats, seq, att_masks=None):
+    def _forward(self, fc_feats, att_feats, seq, att_masks=None, crit=None, masks=None):
+        """
+        Returns the log probs of seq, or, if crit is given, the loss crit gives to
+        seq with the masks, see AttModel._forward.
+        """
+        # the features may be given once per image instead of once per caption
+        seq_per_img = seq.size(0) // att_feats.size(0)
+        target = seq[:, 1:]
         att_feats, seq, att_masks, seq_mask = self._prepare_feature_forward(
             att_feats, att_masks, seq
         )
 
-        out = self.model(att_feats, seq, att_masks, seq_mask)
+        memory = self.model.encode(att_feats, att_masks)
+        if seq_per_img > 1:
+            memory, att_masks = utils.repeat_tensors(seq_per_img, [memory, att_masks])
+        out = self.model.decode(memory, att_masks, seq, seq_mask)
+
+        if crit is not None:
+            # one step at a time, the generator is recomputed in the backward
+            loss = out.new_zeros(())
+            for i in range(out.size(1)):
+                loss = (
+                    loss
+                    + checkpoint(
+                        self.chunk_loss,
+                        out[:, i : i + 1],
+                        target[:, i : i + 1],
+                        masks[:, i + 1 : i + 2],
+                        crit,
+                        use_reentrant=False,
+                    )[0]
+                )
+            return loss / masks[:, 1 : out.size(1) + 1].sum()
 
         outputs = self.model.generator(out)
         return outputs
@@ -375,13 +454,8 @@ class TransformerModel(AttModel):
 
     def core(self, it, fc_feats_ph, att_feats_ph, memory, state, mask):
         """
-        state = [ys.unsqueeze(0)]
+        state = [keys and values of layer i, 2 x batch x steps x d_model, for i in layers]
+        Only the newest token is decoded, the prefix is in the cache.
         """
-        if len(state) == 0:
-            ys = it.unsqueeze(1)
-        else:
-            ys = torch.cat([state[0][0], it.unsqueeze(1)], dim=1)
-        out = self.model.decode(
-            memory, mask, ys, subsequent_mask(ys.size(1)).to(memory.device)
-        )
-        return out[:, -1], [ys.unsqueeze(0)]
+        out, state = self.model.decode_step(memory, mask, it.unsqueeze(1), state)
+        return out[:, -1], state
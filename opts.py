@@ -51,6 +51,24 @@ def parse_opt():
         default="coco-train-idxs",
         help="Cached token file for calculating cider score during self critical training.",
     )
+    parser.add_argument(
+        "--cider_index",
+        type=int,
+        default=0,
+        help="if 1, the CIDEr-D rewards use references precomputed once from input_label_h5 and cached_tokens",
+    )
+    parser.add_argument(
+        "--batched_collate",
+        type=int,
+        default=0,
+        help="if 1, the loader workers return collated batches instead of single images merged in the main process",
+    )
+    parser.add_argument(
+        "--dedup_feats",
+        type=int,
+        default=0,
+        help="if 1, the features of each image are sent once instead of seq_per_img times, and shared by its captions in the model",
+    )
 
     # Model settings
     parser.add_argument(
@@ -96,6 +114,12 @@ def parse_opt():
         "--logit_layers", type=int, default=1, help="number of layers in the RNN"
     )
 
+    parser.add_argument(
+        "--shortlist_predictor",
+        type=int,
+        default=0,
+        help="if 1, the model learns to predict the words of the captions of an image, for --vocab_shortlist",
+    )
     parser.add_argument(
         "--use_bn",
         type=int,
@@ -187,6 +211,36 @@ def parse_opt():
         default=-1,
         help="After what epoch do we start finetuning the CNN? (-1 = disable; never finetune, 0 = finetune from start)",
     )
+    parser.add_argument(
+        "--share_sc_encoder",
+        type=int,
+        default=0,
+        help=(
+            "if 1, self critical training prepares the features once, in train mode, for both the greedy baseline"
+            " and the sampled captions"
+        ),
+    )
+    parser.add_argument(
+        "--greedy_per_img",
+        type=int,
+        default=0,
+        help="if 1, self critical training decodes and scores the greedy baseline once per image instead of once per caption",
+    )
+    parser.add_argument(
+        "--reward_workers",
+        type=int,
+        default=0,
+        help="if > 0, the self critical rewards are scored by this many worker processes",
+    )
+    parser.add_argument(
+        "--reward_pipeline_depth",
+        type=int,
+        default=0,
+        help=(
+            "with reward_workers, the number of batches sampled while the rewards of the previous ones are scored."
+            " The batches are finished before each optimizer step, so it is at most acc_steps - 1"
+        ),
+    )
     parser.add_argument(
         "--seq_per_img",
         type=int,
@@ -207,6 +261,27 @@ def parse_opt():
             " More is not better. Set this to 1 for faster runtime but a bit worse performance."
         ),
     )
+    parser.add_argument(
+        "--batched_beam",
+        type=int,
+        default=1,
+        help="if 1, beam search decodes all the images of a batch at once (group_size 1 only)",
+    )
+    parser.add_argument(
+        "--vocab_shortlist",
+        type=int,
+        default=0,
+        help=(
+            "if > 0, sampling only projects onto the union of the vocab_shortlist words the shortlist predictor"
+            " finds the most likely for each image of the batch, and <eos>"
+        ),
+    )
+    parser.add_argument(
+        "--compact_finished",
+        type=int,
+        default=0,
+        help="if 1, greedy decoding and sampling stop computing the sequences that have finished",
+    )
     parser.add_argument(
         "--max_length", type=int, default=20, help="Maximum length during sampling"
     )
@@ -261,6 +336,21 @@ def parse_opt():
     parser.add_argument("--weight_decay", type=float, default=0, help="weight_decay")
     # Transformer
     parser.add_argument("--label_smoothing", type=float, default=0, help="")
+    parser.add_argument(
+        "--fused_loss",
+        type=int,
+        default=0,
+        help=(
+            "if 1, the attention and transformer models compute the training loss step by step, recomputing the"
+            " log probs in the backward instead of storing them for the whole sequence"
+        ),
+    )
+    parser.add_argument(
+        "--closed_form_smoothing",
+        type=int,
+        default=0,
+        help="if 1, the label smoothing loss is computed in closed form, without a vocab-sized target tensor",
+    )
     parser.add_argument("--noamopt", action="store_true", help="")
     parser.add_argument("--noamopt_warmup", type=int, default=2000, help="")
     parser.add_argument("--noamopt_factor", type=float, default=1, help="")
@@ -450,6 +540,27 @@ def add_eval_options(parser):
             " faster runtime but a bit worse performance."
         ),
     )
+    parser.add_argument(
+        "--batched_beam",
+        type=int,
+        default=1,
+        help="if 1, beam search decodes all the images of a batch at once (group_size 1 only)",
+    )
+    parser.add_argument(
+        "--vocab_shortlist",
+        type=int,
+        default=0,
+        help=(
+            "if > 0, sampling only projects onto the union of the vocab_shortlist words the shortlist predictor"
+            " finds the most likely for each image of the batch, and <eos>"
+        ),
+    )
+    parser.add_argument(
+        "--compact_finished",
+        type=int,
+        default=0,
+        help="if 1, greedy decoding and sampling stop computing the sequences that have finished",
+    )
     parser.add_argument(
         "--max_length", type=int, default=20, help="Maximum length during sampling"
     )
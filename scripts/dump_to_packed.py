@@ -0,0 +1,84 @@
+"""
+Pack the features of an existing feature store (directory of .npy/.npz files,
+.lmdb or .pth dictionary) into a single file that HybridLoader memory-maps.
+
+Output: a directory whose name ends with .packed, containing
+feats.bin: the features of every image, as float32, one after the other
+index.json: {'dtype': 'float32', 'size': total number of floats,
+             'feats': {image id: [offset, shape]}}
+
+Then point --input_fc_dir / --input_att_dir / --input_box_dir to the .packed directory.
+
+For example:
+python scripts/dump_to_packed.py --input_json data/f30ktalk.json --input_dir data/f30kbu_att.pth --output_dir data/f30kbu_att.packed
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import os
+import json
+import argparse
+
+import numpy as np
+from tqdm import tqdm
+
+from dataloader import HybridLoader
+
+
+def main(params):
+    assert params["output_dir"].endswith(
+        ".packed"
+    ), "output_dir should end with .packed, otherwise HybridLoader won't recognize it"
+    images = json.load(open(params["input_json"], "r"))["images"]
+    loader = HybridLoader(params["input_dir"], params["ext"])
+
+    if not os.path.isdir(params["output_dir"]):
+        os.makedirs(params["output_dir"])
+
+    index = {}
+    offset = 0
+    with open(os.path.join(params["output_dir"], "feats.bin"), "wb") as f:
+        for img in tqdm(images):
+            key = str(img["id"])
+            if key in index:
+                continue
+            feat = np.ascontiguousarray(loader.get(key), dtype="float32")
+            f.write(feat.tobytes())
+            index[key] = [offset, list(feat.shape)]
+            offset += feat.size
+
+    with open(os.path.join(params["output_dir"], "index.json"), "w") as f:
+        json.dump({"dtype": "float32", "size": offset, "feats": index}, f)
+    print(
+        "packed %d images (%d floats) into %s"
+        % (len(index), offset, params["output_dir"])
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument(
+        "--input_json",
+        default="data/f30ktalk.json",
+        help="json file produced by prepro_labels.py, the ids of its images are packed",
+    )
+    parser.add_argument(
+        "--input_dir",
+        default="data/f30kbu_att.pth",
+        help="existing feature store: a directory, a .lmdb or a .pth file",
+    )
+    parser.add_argument(
+        "--ext",
+        default=".npz",
+        help="extension of the feature files (.npy or .npz), ignored for .pth",
+    )
+    parser.add_argument(
+        "--output_dir", default="data/f30kbu_att.packed", help="output directory"
+    )
+    args = parser.parse_args()
+    params = vars(args)  # convert to ordinary dict
+
+    main(params)
@@ -13,21 +13,23 @@ Output: a json file and an hdf5 file
 The hdf5 file contains several fields:
 /images is (N,3,256,256) uint8 array of raw image data in RGB format
 /labels is (M,max_length) uint32 array of encoded labels, zero padded
-/label_start_ix and /label_end_ix are (N,) uint32 arrays of pointers to the 
+/label_start_ix and /label_end_ix are (N,) uint32 arrays of pointers to the
   first and last indices (in range 1..M) of labels for each image
 /label_length stores the length of the sequence for each of the M sequences
 
 The json file has a dict that contains:
 - an 'ix_to_word' field storing the vocab in form {ix:'word'}, where ix is 1-indexed
-- an 'images' field that is a list holding auxiliary information for each image, 
+- an 'images' field that is a list holding auxiliary information for each image,
   such as in particular the 'split' it was assigned to.
 """
 
 import os
 import json
 import argparse
+import multiprocessing
 from six.moves import cPickle
 import misc.utils as utils
+from misc.cider import save_df
 from collections import defaultdict
 
 
@@ -60,37 +62,16 @@ def cook_refs(refs, n=4):  ## lhuang: oracle will call with "average"
     return [precook(ref, n) for ref in refs]
 
 
-def create_crefs(refs):
-    crefs = []
-    for ref in refs:
-        # ref is a list of 5 captions
-        crefs.append(cook_refs(ref))
-    return crefs
-
-
-def compute_doc_freq(crefs):
+def count_doc_freq(args):
     """
-    Compute term frequency for reference data.
-    This will be used to compute idf (inverse document frequency later)
-    The term frequency is stored in the object
-    :return: None
+    Document frequencies of the word and of the idx n-grams of the images of a
+    shard, and the number of images counted. Every sentence is tokenized once,
+    the idx n-grams are the word n-grams mapped through wtoi.
     """
-    document_frequency = defaultdict(float)
-    for refs in crefs:
-        # refs, k ref captions of one image
-        for ngram in set([ngram for ref in refs for (ngram, count) in ref.items()]):
-            document_frequency[ngram] += 1
-            # maxcounts[ngram] = max(maxcounts.get(ngram,0), count)
-    return document_frequency
-
-
-def build_dict(imgs, wtoi, params):
-    wtoi["<eos>"] = 0
-
+    imgs, wtoi, params = args
+    ngram_words = defaultdict(float)
+    ngram_idxs = defaultdict(float)
     count_imgs = 0
-
-    refs_words = []
-    refs_idxs = []
     for img in imgs:
         if (
             (params["split"] == img["split"])
@@ -98,8 +79,8 @@ def build_dict(imgs, wtoi, params):
             or (params["split"] == "all")
         ):
             # (params['split'] == 'val' and img['split'] == 'restval') or \
-            ref_words = []
-            ref_idxs = []
+            # the n-grams of the k ref captions of the image
+            ngrams = set()
             for sent in img["sentences"]:
                 if hasattr(params, "bpe"):
                     sent["tokens"] = (
@@ -107,15 +88,35 @@ def build_dict(imgs, wtoi, params):
                     )
                 tmp_tokens = sent["tokens"] + ["<eos>"]
                 tmp_tokens = [_ if _ in wtoi else "UNK" for _ in tmp_tokens]
-                ref_words.append(" ".join(tmp_tokens))
-                ref_idxs.append(" ".join([str(wtoi[_]) for _ in tmp_tokens]))
-            refs_words.append(ref_words)
-            refs_idxs.append(ref_idxs)
+                ngrams.update(precook(" ".join(tmp_tokens)))
+            for ngram in ngrams:
+                ngram_words[ngram] += 1
+                ngram_idxs[tuple(str(wtoi[_]) for _ in ngram)] += 1
             count_imgs += 1
+    return ngram_words, ngram_idxs, count_imgs
+
+
+def build_dict(imgs, wtoi, params):
+    wtoi["<eos>"] = 0
+
+    num_workers = params.get("num_workers", 1)
+    shards = [(imgs[i::num_workers], wtoi, params) for i in range(num_workers)]
+    if num_workers > 1:
+        with multiprocessing.Pool(num_workers) as pool:
+            counts = pool.map(count_doc_freq, shards)
+    else:
+        counts = [count_doc_freq(shards[0])]
+
+    # merge the document frequencies of the shards
+    ngram_words, ngram_idxs, count_imgs = counts[0]
+    for shard_words, shard_idxs, shard_imgs in counts[1:]:
+        for ngram, freq in shard_words.items():
+            ngram_words[ngram] += freq
+        for ngram, freq in shard_idxs.items():
+            ngram_idxs[ngram] += freq
+        count_imgs += shard_imgs
     print("total imgs:", count_imgs)
 
-    ngram_words = compute_doc_freq(create_crefs(refs_words))
-    ngram_idxs = compute_doc_freq(create_crefs(refs_idxs))
     return ngram_words, ngram_idxs, count_imgs
 
 
@@ -146,10 +147,15 @@ def main(params):
         {"document_frequency": ngram_words, "ref_len": ref_len},
         open(params["output_pkl"] + "-words.p", "wb"),
     )
+    # the pickle is written in both formats: the rewards without --cider_index
+    # are scored by pyciderevalcap, which only reads it
     utils.pickle_dump(
         {"document_frequency": ngram_idxs, "ref_len": ref_len},
         open(params["output_pkl"] + "-idxs.p", "wb"),
     )
+    if params["df_format"] == "bin":
+        # hashed n-grams in sorted arrays, memory-mapped by misc.cider.CiderDIndex
+        save_df(params["output_pkl"] + "-idxs.bin", ngram_idxs, ref_len)
 
 
 if __name__ == "__main__":
@@ -168,6 +174,21 @@ if __name__ == "__main__":
         "--output_pkl", default="data/coco-all", help="output pickle file"
     )
     parser.add_argument("--split", default="all", help="test, val, train, all")
+    parser.add_argument(
+        "--num_workers",
+        type=int,
+        default=1,
+        help="number of processes the images are split between",
+    )
+    parser.add_argument(
+        "--df_format",
+        default="pkl",
+        choices=["pkl", "bin"],
+        help=(
+            "format of the idxs table: pkl for pyciderevalcap, or bin to also write it as a .bin file, memory-mapped"
+            " by --cider_index training; the words table is always a pickle"
+        ),
+    )
     args = parser.parse_args()
     params = vars(args)  # convert to ordinary dict
 
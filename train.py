@@ -10,6 +10,7 @@ import numpy as np
 
 import time
 import os
+import collections
 from six.moves import cPickle
 import traceback
 
@@ -19,7 +20,7 @@ from dataloader import *
 import skimage.io
 import eval_utils
 import misc.utils as utils
-from misc.rewards import init_scorer, get_self_critical_reward
+from misc.rewards import init_scorer, get_self_critical_reward, RewardPool
 from misc.loss_wrapper import LossWrapper
 
 try:
@@ -98,6 +99,11 @@ def train(opt):
     # Assure in training mode
     dp_lw_model.train()
 
+    # self critical batches sampled, whose rewards are being scored by reward_pool
+    reward_pool = None
+    sc_pending = collections.deque()
+    sc_out = None
+
     if opt.noamopt:
         assert opt.caption_model in [
             "transformer",
@@ -120,6 +126,16 @@ def train(opt):
             torch.load(os.path.join(opt.start_from, "optimizer.pth"))
         )
 
+    def finish_sc(model_out, pending):
+        # backward of a self critical batch once reward_pool has scored it
+        reward = reward_pool.result(pending)
+        reward = torch.from_numpy(reward).float().to(model_out["gen_result"].device)
+        loss = lw_model.rl_crit(
+            model_out["sample_logprobs"], model_out["gen_result"].data, reward
+        )
+        (loss / acc_steps).backward()
+        return {"loss": loss, "reward": reward[:, 0].mean()}
+
     def save_checkpoint(model, infos, optimizer, histories=None, append=""):
         if len(append) > 0:
             append = "-" + append
@@ -179,7 +195,16 @@ def train(opt):
                 # If start self critical training
                 if opt.self_critical_after != -1 and epoch >= opt.self_critical_after:
                     sc_flag = True
-                    init_scorer(opt.cached_tokens)
+                    init_scorer(
+                        opt.cached_tokens,
+                        opt.input_label_h5 if opt.cider_index else None,
+                    )
+                    if opt.reward_workers > 0 and reward_pool is None:
+                        reward_pool = RewardPool(
+                            opt.reward_workers,
+                            opt.cached_tokens,
+                            opt.input_label_h5 if opt.cider_index else None,
+                        )
                 else:
                     sc_flag = False
 
@@ -219,12 +244,37 @@ def train(opt):
                 data["gts"],
                 torch.arange(0, len(data["gts"])),
                 sc_flag,
+                torch.tensor([_["ix"] for _ in data["infos"]]),
             )
 
-            loss = model_out["loss"].mean()
-            loss_sp = loss / acc_steps
+            if "loss" in model_out:
+                loss = model_out["loss"].mean()
+                loss_sp = loss / acc_steps
 
-            loss_sp.backward()
+                loss_sp.backward()
+            else:
+                # score the rewards of this batch while the next ones are
+                # sampled, the gradients of all of them are needed at the step
+                sc_pending.append(
+                    (
+                        model_out,
+                        reward_pool.submit(
+                            model_out["greedy_res"],
+                            data["gts"],
+                            model_out["gen_result"],
+                            opt,
+                            [_["ix"] for _ in data["infos"]],
+                        ),
+                    )
+                )
+                depth = opt.reward_pipeline_depth
+                if (iteration + 1) % acc_steps == 0:
+                    depth = 0
+                while len(sc_pending) > depth or sc_out is None:
+                    sc_out = finish_sc(*sc_pending.popleft())
+                # report the last batch whose rewards are known
+                model_out = sc_out
+                loss = model_out["loss"]
             if (iteration + 1) % acc_steps == 0:
                 utils.clip_gradient(optimizer, opt.grad_clip)
                 optimizer.step()
@@ -350,6 +400,9 @@ def train(opt):
         print("Save ckpt done.")
         stack_trace = traceback.format_exc()
         print(stack_trace)
+    finally:
+        if reward_pool is not None:
+            reward_pool.shutdown()
 
 
 opt = opts.parse_opt()
@@ -1,9 +1,13 @@
+import asyncio
 import json
 import os.path
 from asyncio import Lock
 from copy import copy
+from json import JSONDecodeError
 from pathlib import Path
 
+from translation.translation_cache import TranslationCache
+
 
 class BaseTranslator:
     def __init__(
@@ -16,6 +20,8 @@ class BaseTranslator:
         / "flickr30k_dataset.json",
         source_language: str = "en",
         dest_language: str = "pt",
+        journal_output: bool = False,
+        use_cache: bool = True,
     ):
         """
         Translator base class
@@ -26,6 +32,10 @@ class BaseTranslator:
         :param output_path: Where the translated json should be saved.
         :param source_language: The source language of translation.
         :param dest_language: The destination language of translation.
+        :param journal_output: Append each translated image to a jsonl journal instead of rewriting the output
+            and checkpoint jsons, these are written by compact_journal.
+        :param use_cache: Look the sentences up in the translation cache of checkpoint_path before translating them,
+            and add the new translations to it.
         """
         self.translator_identifier = translator_identifier
         self.checkpoint_path = checkpoint_path
@@ -38,10 +48,32 @@ class BaseTranslator:
         self._checkpoint_dictionary = dict()
         self.output_lock = Lock()
         self.max_sentence_batches = 25
+        self.journal_output = journal_output
+        # journal records written between two fsyncs
+        self.journal_sync_every = 25
+        self._journal_file = None
+        self._journal_unsynced = 0
+        self.translation_cache = None
+        # futures of the normalized sentences being translated
+        self._translations_in_flight = {}
+        if use_cache:
+            # shared by the translators, its keys include the translator identifier
+            self.translation_cache = TranslationCache(
+                self.checkpoint_path / "translation_cache.sqlite3"
+            )
 
         self.load_checkpoint()
         self.read_source_json()
         self.create_or_load_ouput_json()
+        if self.journal_output:
+            self.open_journal()
+
+    @property
+    def journal_path(self) -> Path:
+        return (
+            self.output_path
+            / f"{self.translator_identifier}_{self.dest_language}_flicker30k.jsonl"
+        )
 
     def read_source_json(self):
         """
@@ -85,6 +117,115 @@ class BaseTranslator:
         """
         raise NotImplementedError
 
+    def get_cached_translations(self, image: dict) -> [str]:
+        """
+        Looks the sentences of an image up in the translation cache.
+
+        :return: The translation of each sentence, None for the sentences to translate.
+        """
+        sentences = [sentence["raw"] for sentence in image["sentences"]]
+        if self.translation_cache is None:
+            return [None] * len(sentences)
+        return self.translation_cache.get_many(
+            sentences,
+            self.source_language,
+            self.dest_language,
+            self.translator_identifier,
+        )
+
+    async def translate_missing_sentences(
+        self, images: [dict], send_sentences, whole_images: bool = False
+    ) -> dict:
+        """
+        Translates the sentences of images missing from the translation cache, and adds them to it.
+        Each sentence (once normalized) is sent once, even when it is repeated in the images or is being translated
+        by another batch at the same time.
+
+        :param images: The images to translate.
+        :param send_sentences: Coroutine function translating {image id: {sentence id: sentence}}, it returns the
+            translated sentences of each image, in the same order.
+        :param whole_images: Send all the sentences of an image with a sentence to send.
+        :return: The translation of each sentence of each image, by image id.
+        """
+        translations_dict = {}
+        sending = {}
+        # the sentences this batch sends, the other batches wait for their future
+        claimed = {}
+        for image in images:
+            translations = self.get_cached_translations(image)
+            sentences = {}
+            for sentid, sentence in enumerate(image["sentences"]):
+                if translations[sentid] is not None:
+                    continue
+                key = TranslationCache.normalize(sentence["raw"])
+                if key not in self._translations_in_flight:
+                    future = asyncio.get_running_loop().create_future()
+                    self._translations_in_flight[key] = claimed[key] = future
+                    sentences[sentid] = sentence["raw"]
+                translations[sentid] = self._translations_in_flight[key]
+            if sentences and whole_images:
+                sentences = {
+                    sentid: sentence["raw"]
+                    for sentid, sentence in enumerate(image["sentences"])
+                }
+            if sentences:
+                sending[image["imgid"]] = sentences
+            translations_dict[image["imgid"]] = translations
+
+        try:
+            results = await send_sentences(sending) if sending else []
+            new_sentences, new_translations = [], []
+            for sentences, translated_sentences in zip(sending.values(), results):
+                for sentence, translation in zip(
+                    sentences.values(), translated_sentences
+                ):
+                    future = claimed.get(TranslationCache.normalize(sentence))
+                    if future is not None and not future.done():
+                        future.set_result(translation)
+                        new_sentences.append(sentence)
+                        new_translations.append(translation)
+            if self.translation_cache is not None:
+                self.translation_cache.put_many(
+                    new_sentences,
+                    new_translations,
+                    self.source_language,
+                    self.dest_language,
+                    self.translator_identifier,
+                )
+        except BaseException as error:
+            self._release_claimed_sentences(claimed, error)
+            raise
+        self._release_claimed_sentences(
+            claimed, Exception("No translation returned for the sentence...")
+        )
+
+        return {
+            image_id: [
+                (
+                    await translation
+                    if isinstance(translation, asyncio.Future)
+                    else translation
+                )
+                for translation in translations
+            ]
+            for image_id, translations in translations_dict.items()
+        }
+
+    def _release_claimed_sentences(self, claimed: dict, error: BaseException):
+        """
+        Fails the claimed sentences left without a translation and forgets them all.
+        """
+        for key, future in claimed.items():
+            if future.done():
+                pass
+            elif isinstance(error, asyncio.CancelledError):
+                future.cancel()
+            else:
+                future.set_exception(error)
+                # retrieved, so that asyncio doesn't log it if no batch waits for it
+                future.exception()
+            del self._translations_in_flight[key]
+
     async def append_translated_sentences_to_output(
         self, translation_dict: dict, checkpoint_data: dict
     ):
@@ -92,6 +233,13 @@ class BaseTranslator:
         Appends translated sentences information to output json.
         Saves checkpoint data.
         """
+        if self.journal_output:
+            async with self.output_lock:
+                self.append_to_journal(
+                    {"image": translation_dict, "checkpoint": checkpoint_data}
+                )
+            return
+
         old_flickr_dest_json = copy(self._flickr_dest_json)
         old_checkpoint = copy(self._checkpoint_dictionary)
         try:
@@ -145,3 +293,101 @@ class BaseTranslator:
                 "r",
             ) as file:
                 self._flickr_dest_json = json.loads(file.read())
+
+    def read_journal(self) -> ([dict], int):
+        """
+        Reads the output journal.
+
+        :return: Its records, and the size of the file up to the last complete one (a record may have been cut by
+            an interrupted run).
+        """
+        records = []
+        valid_size = 0
+        if not os.path.exists(self.journal_path):
+            return records, valid_size
+        with open(self.journal_path, "rb") as file:
+            for line in file:
+                if not line.endswith(b"\n"):
+                    break
+                try:
+                    records.append(json.loads(line))
+                except (JSONDecodeError, UnicodeDecodeError):
+                    break
+                valid_size += len(line)
+        return records, valid_size
+
+    def open_journal(self):
+        """
+        Rebuilds the checkpoint from the output journal and opens it for appending.
+        """
+        records, valid_size = self.read_journal()
+        for record in records:
+            self._checkpoint_dictionary.update(record["checkpoint"])
+        self._journal_file = open(self.journal_path, "ab")
+        self._journal_file.truncate(valid_size)
+
+    def append_to_journal(self, record: dict):
+        """
+        Appends a record to the output journal, it is fsynced every journal_sync_every records.
+
+        :param record: The translated image and its checkpoint data.
+        """
+        self._journal_file.write((json.dumps(record) + "\n").encode())
+        self._checkpoint_dictionary.update(
+            {str(key): value for key, value in record["checkpoint"].items()}
+        )
+        self._journal_unsynced += 1
+        if self._journal_unsynced >= self.journal_sync_every:
+            self.sync_journal()
+
+    def sync_journal(self):
+        """
+        Flushes the output journal to disk.
+        """
+        self._journal_file.flush()
+        os.fsync(self._journal_file.fileno())
+        self._journal_unsynced = 0
+
+    def compact_journal(self):
+        """
+        Writes the output json and the checkpoint json with the images of the output journal, then empties it.
+        """
+        self.sync_journal()
+        records, _ = self.read_journal()
+        images = self._flickr_dest_json["images"]
+        # an interrupted compaction may have written some of the records already
+        done_img_ids = {image["imgid"] for image in images}
+        for record in records:
+            if record["image"]["imgid"] not in done_img_ids:
+                images.append(record["image"])
+                done_img_ids.add(record["image"]["imgid"])
+        # the records are in completion order when batches run concurrently
+        source_order = {
+            image["imgid"]: index
+            for index, image in enumerate(self._flickr_source_json["images"])
+        }
+        images.sort(
+            key=lambda image: source_order.get(image["imgid"], len(source_order))
+        )
+
+        output_json = (
+            self.output_path
+            / f"{self.translator_identifier}_{self.dest_language}_flicker30k.json"
+        )
+        checkpoint_json = (
+            self.checkpoint_path
+            / f"{self.translator_identifier}_{self.dest_language}_flicker30k_checkpoint.json"
+        )
+        for path, data in (
+            (output_json, self._flickr_dest_json),
+            (checkpoint_json, self._checkpoint_dictionary),
+        ):
+            # replaced at once, so that an interruption leaves the old or the new file
+            with open(f"{path}.tmp", "w") as file:
+                file.write(json.dumps(data))
+                file.flush()
+                os.fsync(file.fileno())
+            os.replace(f"{path}.tmp", path)
+
+        self._journal_file.truncate(0)
+        self.sync_journal()
@@ -26,6 +26,8 @@ class GoogleCloudTranslate(BaseTranslator):
         / "flickr30k_dataset.json",
         source_language: str = "en-US",
         dest_language: str = "pt-BR",
+        journal_output: bool = False,
+        use_cache: bool = True,
     ):
         """
         GoogleCloud Translator
@@ -35,6 +37,8 @@ class GoogleCloudTranslate(BaseTranslator):
         :param output_path: Where the translated json should be saved.
         :param source_language: The source language of translation.
         :param dest_language: The destination language of translation.
+        :param journal_output: Append the translated images to a jsonl journal, see BaseTranslator.
+        :param use_cache: Use the translation cache, see BaseTranslator.
         """
         super().__init__(
             translator_identifier="googlecloud",
@@ -43,12 +47,13 @@ class GoogleCloudTranslate(BaseTranslator):
             source_json=source_json,
             source_language=source_language,
             dest_language=dest_language,
+            journal_output=journal_output,
+            use_cache=use_cache,
         )
         self.max_sentence_batches = 50
 
     async def translate_sentences(self):
         translating_img_ids = []
-        translating_sentences = []
         images = self._flickr_source_json["images"]
         infos_dict = {}
 
@@ -57,20 +62,20 @@ class GoogleCloudTranslate(BaseTranslator):
             infos_dict[image_id] = image
             if str(image_id) not in self._checkpoint_dictionary:
                 translating_img_ids.append(image_id)
-                translating_sentences.extend(
-                    [[sentence["raw"] for sentence in image["sentences"]]]
-                )
 
             if (
                 len(translating_img_ids) >= self.max_sentence_batches
                 or image_id == images[-1]["imgid"]
             ):
-                results = await self.send_sentences_to_api(translating_sentences)
+                # only the sentences missing from the cache are sent
+                translations = await self.translate_missing_sentences(
+                    [infos_dict[image_id] for image_id in translating_img_ids],
+                    self.send_missing_sentences,
+                )
                 parse_coros = []
-                for index, result in enumerate(results):
-                    image_id = translating_img_ids[index]
-                    translated_sentences = result
+                for image_id in translating_img_ids:
                     translation_dict = infos_dict[image_id]
+                    translated_sentences = translations[image_id]
                     for sentid, sentence in enumerate(translation_dict["sentences"]):
                         sentence["raw"] = translated_sentences[sentid]
                         sentence["tokens"] = (
@@ -85,7 +90,14 @@ class GoogleCloudTranslate(BaseTranslator):
 
                 await asyncio.gather(*parse_coros)
                 translating_img_ids = []
-                translating_sentences = []
+
+    async def send_missing_sentences(self, images_sentences: dict) -> [[str]]:
+        """
+        Sends the sentences of translate_missing_sentences, a request per image
+        """
+        return await self.send_sentences_to_api(
+            [list(sentences.values()) for sentences in images_sentences.values()]
+        )
 
     async def send_sentences_to_api(self, sentences_matrix: [[str]]) -> (int, [str]):
         """
@@ -126,10 +138,13 @@ async def main():
     os.makedirs(data_path, exist_ok=True)
 
     googlecloud_translator = GoogleCloudTranslate(
-        checkpoint_path=checkpoint_path, output_path=data_path
+        checkpoint_path=checkpoint_path, output_path=data_path, journal_output=True
     )
 
-    await googlecloud_translator.translate_sentences()
+    try:
+        await googlecloud_translator.translate_sentences()
+    finally:
+        googlecloud_translator.compact_journal()
 
 
 if __name__ == "__main__":
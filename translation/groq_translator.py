@@ -14,12 +14,13 @@ from copy import copy
 from json import JSONDecodeError
 from pathlib import Path
 
-from groq import Groq
+from groq import APIConnectionError, AsyncGroq, InternalServerError, RateLimitError
 
 from translation.base_translator import BaseTranslator
 from tqdm import tqdm
 
 from translation.config import settings
+from translation.rate_limiter import RateLimiter
 
 
 class InvalidSentencesQuantity(Exception):
@@ -53,6 +54,9 @@ class GroqTranslate(BaseTranslator):
         / "flickr30k_dataset.json",
         source_language: str = "en-US",
         dest_language: str = "pt-BR",
+        journal_output: bool = False,
+        use_cache: bool = True,
+        prompt_token_budget: int = None,
     ):
         """
         Groq Translator
@@ -62,6 +66,10 @@ class GroqTranslate(BaseTranslator):
         :param output_path: Where the translated json should be saved.
         :param source_language: The source language of translation.
         :param dest_language: The destination language of translation.
+        :param journal_output: Append the translated images to a jsonl journal, see BaseTranslator.
+        :param use_cache: Use the translation cache, see BaseTranslator.
+        :param prompt_token_budget: If set, each prompt holds the sentences of as many images as fit in this
+            number of (estimated) tokens, instead of the sentences of one image.
         """
         super().__init__(
             translator_identifier="groq",
@@ -70,6 +78,8 @@ class GroqTranslate(BaseTranslator):
             source_json=source_json,
             source_language=source_language,
             dest_language=dest_language,
+            journal_output=journal_output,
+            use_cache=use_cache,
         )
 
         self.base_prompt = (
@@ -82,15 +92,42 @@ class GroqTranslate(BaseTranslator):
             'DO NOT USE \\" TO REPRESENT QUOTES OF JSON DELIMITERS.'
         )
 
+        # answer keyed by image id then sentence id, for the packed prompts
+        self.packed_prompt = (
+            f"TRANSLATE THE SENTENCES OF THE FOLLOWING JSON FROM {self.source_language.upper()} TO "
+            f"{self.dest_language.upper()}, ITS KEYS ARE IMAGE IDS AND THEN SENTENCE IDS:"
+            f"\n\nREPLACE_THIS_WITH_SENTENCES"
+            "\n\nAND RETURN THEM INTO THE SAME JSON STRUCTURE, WITH THE SAME IMAGE IDS AND SENTENCE IDS, "
+            "REPLACING THE ORIGINAL SENTENCE FOR THE TRANSLATED ONE.\nSTRICT RULES:\n"
+            "DO NOT ANSWER ANYTHING BESIDES THE JSON\nRETURN A VALID JSON THAT CAN BE"
+            " PARSED BY PYTHON json.loads FUNCTION\nDO NOT MODIFY THE JSON STRUCTURE.\n"
+            'DO NOT USE \\" TO REPRESENT QUOTES OF JSON DELIMITERS.'
+        )
+        self.prompt_token_budget = prompt_token_budget
+        # prompts sent for the images of a batch before giving up on the invalid answers
+        self.max_packed_rounds = 5
+
         self.max_sentence_batches = 30
-        self.groq_client = Groq(api_key=settings.api_keys.GROQ_API_KEY)
+        if self.prompt_token_budget:
+            # images per batch, spread over several packed prompts
+            self.max_sentence_batches = 300
+        # the retries are made by the rate limiter
+        self.groq_client = AsyncGroq(
+            api_key=settings.api_keys.GROQ_API_KEY, max_retries=0
+        )
         self.requests_made = 0
         # llama3-8b-8192 was chosen because the balance beetween tokens per minute/answer quality
         self.base_llm_model = "llama3-8b-8192"
+        # Groq (llama3-8b-8192) has a limit of 30 requests per minute and 14400 requests per day
+        self.rate_limiter = RateLimiter(
+            requests_per_minute=30,
+            requests_per_day=14390,
+            max_concurrency=8,
+            retry_exceptions=(RateLimitError, APIConnectionError, InternalServerError),
+        )
 
     async def translate_sentences(self):
         translating_img_ids = []
-        translating_sentences = []
         images = self._flickr_source_json["images"]
         infos_dict = {}
 
@@ -103,26 +140,23 @@ class GroqTranslate(BaseTranslator):
             infos_dict[image_id] = image
             if str(image_id) not in self._checkpoint_dictionary:
                 translating_img_ids.append(image_id)
-                prompt = copy(self.base_prompt)
-                joined_sentences = json.dumps(
-                    {
-                        index: sentence["raw"]
-                        for index, sentence in enumerate(image["sentences"])
-                    }
-                )
-                prompt = prompt.replace("REPLACE_THIS_WITH_SENTENCES", joined_sentences)
-                translating_sentences.append(prompt)
 
             if (
                 len(translating_img_ids) >= self.max_sentence_batches
                 or image_id == images[-1]["imgid"]
             ):
-                results = await self.send_sentences_to_api(translating_sentences)
+                # the prompts of a single image hold its 5 sentences, so an image with
+                # a sentence to translate is sent entirely, the packed prompts are
+                # keyed by sentence id and hold only the sentences to translate
+                translations = await self.translate_missing_sentences(
+                    [infos_dict[image_id] for image_id in translating_img_ids],
+                    self.send_missing_sentences,
+                    whole_images=not self.prompt_token_budget,
+                )
                 parse_coros = []
-                for index, result in enumerate(results):
-                    image_id = translating_img_ids[index]
-                    translated_sentences = result
+                for image_id in translating_img_ids:
                     translation_dict = infos_dict[image_id]
+                    translated_sentences = translations[image_id]
                     for sentid, sentence in enumerate(translation_dict["sentences"]):
                         sentence["raw"] = translated_sentences[sentid]
                         sentence["tokens"] = (
@@ -137,17 +171,37 @@ class GroqTranslate(BaseTranslator):
 
                 await asyncio.gather(*parse_coros)
                 translating_img_ids = []
-                translating_sentences = []
 
-                # Groq (llama3-8b-8192) has a limit of 30 requests per minute
-                await asyncio.sleep(65)
+    async def send_missing_sentences(self, images_sentences: dict) -> [[str]]:
+        """
+        Sends the sentences of translate_missing_sentences, in packed prompts if prompt_token_budget is set,
+        else in a prompt per image
+        """
+        if self.prompt_token_budget:
+            return await self.send_packed_sentences_to_api(
+                list(images_sentences.items())
+            )
+        return await self.send_sentences_to_api(
+            [
+                self.base_prompt.replace(
+                    "REPLACE_THIS_WITH_SENTENCES", json.dumps(sentences)
+                )
+                for sentences in images_sentences.values()
+            ]
+        )
 
     @staticmethod
     def write_wrong_answer_to_disk(llm_original_anwser):
         with open("translation_data/llm_invalid_answers.txt", "a") as error_file:
             error_file.write(llm_original_anwser + "\n")
 
-    def assert_valid_answer(self, answer):
+    def assert_valid_answer(self, answer, check_length: bool = True):
+        """
+        Fixes the common json errors of an llm answer.
+
+        :param check_length: Rejects the answers shorter than the answer of 5 sentences, the packed answers
+            are checked image by image instead.
+        """
         found_error = False
 
         original_answer = copy(answer)
@@ -156,7 +210,7 @@ class GroqTranslate(BaseTranslator):
             if "}" not in answer:
                 answer = answer[:-1] + "}"
             else:
-                char_position = answer.find("}")
+                char_position = answer.rfind("}")
                 if char_position != -1:
                     answer = answer[: char_position + 1]
             found_error = True
@@ -170,7 +224,7 @@ class GroqTranslate(BaseTranslator):
                     answer = answer[char_position:]
             found_error = True
 
-        if len(answer) < 100:
+        if check_length and len(answer) < 100:
             raise InvalidAnswer()
 
         answer = answer.strip()
@@ -193,24 +247,31 @@ class GroqTranslate(BaseTranslator):
     async def send_sentences_to_api(self, sentences_matrix: [str]) -> (int, [str]):
         """
         Send sentences to groq llm api and returns translated sentences
+        The prompts are sent concurrently, within the limits of rate_limiter
+        """
+        return await asyncio.gather(
+            *[self.translate_prompt(prompt) for prompt in sentences_matrix]
+        )
+
+    async def translate_prompt(self, prompt: str) -> [str]:
+        """
+        Send a prompt to groq llm api until the answer is valid and returns its translated sentences
         """
 
         def parse_response(response_text_):
-            nonlocal translated_sentences_matrix
             json_result_ = json.loads(response_text_)
             if len(json_result_.keys()) != 5:
                 raise InvalidSentencesQuantity()
             sentences_ = list(json_result_.values())
             if any(len(sentence_) <= 10 for sentence_ in sentences_):
                 raise InvalidSentenceSize()
-            translated_sentences_matrix.append(list(json_result_.values()))
+            return sentences_
 
-        translated_sentences_matrix = []
-        for prompt in sentences_matrix:
-            while True:
-                # Tries until get a valid json or another error occurs
-                try:
-                    reponse = self.groq_client.chat.completions.create(
+        while True:
+            # Tries until get a valid json or another error occurs
+            try:
+                reponse = await self.rate_limiter.run(
+                    lambda: self.groq_client.chat.completions.create(
                         messages=[
                             {
                                 "role": "user",
@@ -219,33 +280,171 @@ class GroqTranslate(BaseTranslator):
                         ],
                         model=self.base_llm_model,
                     )
+                )
 
-                    self.requests_made += 1
+                self.requests_made += 1
 
-                    if self.requests_made >= 14400:
-                        raise Exception("Requests per day limit reached...")
+                if self.requests_made >= 14400:
+                    raise Exception("Requests per day limit reached...")
 
-                    original_response_text = reponse.choices[0].message.content
-                    response_text = self.assert_valid_answer(
-                        copy(original_response_text)
+                original_response_text = reponse.choices[0].message.content
+                response_text = self.assert_valid_answer(copy(original_response_text))
+                try:
+                    return parse_response(response_text)
+                except JSONDecodeError:
+                    self.write_wrong_answer_to_disk(original_response_text)
+                    # Try to parse again replacing \" for ", that's a common llm error
+                    response_text = response_text.replace('\\"', '"')
+                    return parse_response(response_text)
+            except (
+                JSONDecodeError,
+                InvalidSentencesQuantity,
+                InvalidAnswer,
+                InvalidSentenceSize,
+            ):
+                continue
+
+    @staticmethod
+    def estimate_tokens(text: str) -> int:
+        """
+        Rough number of llm tokens of a text, about 4 characters per token
+        """
+        return len(text) // 4 + 1
+
+    def pack_sentences(
+        self, images_sentences: [(int, dict)]
+    ) -> ([str], [[(int, dict)]]):
+        """
+        Packs the sentences of several images into prompts of at most prompt_token_budget tokens.
+
+        :param images_sentences: The image ids and their sentences, keyed by sentence id.
+        :return: The prompts, and the images of each prompt.
+        """
+        prompt_overhead = self.estimate_tokens(
+            self.packed_prompt.replace("REPLACE_THIS_WITH_SENTENCES", "")
+        )
+        packs = [[]]
+        pack_tokens = prompt_overhead
+        for image_id, sentences in images_sentences:
+            image_tokens = self.estimate_tokens(json.dumps({str(image_id): sentences}))
+            if packs[-1] and pack_tokens + image_tokens > self.prompt_token_budget:
+                packs.append([])
+                pack_tokens = prompt_overhead
+            packs[-1].append((image_id, sentences))
+            pack_tokens += image_tokens
+
+        prompts = [
+            self.packed_prompt.replace(
+                "REPLACE_THIS_WITH_SENTENCES",
+                json.dumps({str(image_id): sentences for image_id, sentences in pack}),
+            )
+            for pack in packs
+        ]
+        return prompts, packs
+
+    async def send_packed_sentences_to_api(
+        self, images_sentences: [(int, dict)]
+    ) -> [[str]]:
+        """
+        Send the sentences of several images to groq llm api in packed prompts and returns translated sentences
+        The images whose answer is invalid are packed and sent again, up to max_packed_rounds times.
+
+        :param images_sentences: The image ids and their sentences, keyed by sentence id.
+        :return: The translated sentences of each image, in sentence id order.
+        """
+        translations = {}
+        pending = images_sentences
+        for _ in range(self.max_packed_rounds):
+            if not pending:
+                break
+            prompts, packs = self.pack_sentences(pending)
+            answers = await asyncio.gather(
+                *[
+                    self.translate_packed_prompt(prompt, pack)
+                    for prompt, pack in zip(prompts, packs)
+                ]
+            )
+            for answer in answers:
+                translations.update(answer)
+            pending = [
+                (image_id, sentences)
+                for image_id, sentences in pending
+                if image_id not in translations
+            ]
+        if pending:
+            raise InvalidAnswer(
+                f"No valid answer for images {[image_id for image_id, _ in pending]} "
+                f"after {self.max_packed_rounds} rounds..."
+            )
+
+        return [translations[image_id] for image_id, _ in images_sentences]
+
+    async def translate_packed_prompt(self, prompt: str, pack: [(int, dict)]) -> dict:
+        """
+        Send a packed prompt to groq llm api and returns the translated sentences of the images with a valid answer
+        """
+
+        def parse_image_response(image_result_, sentences_):
+            if not isinstance(image_result_, dict) or set(image_result_.keys()) != {
+                str(sentid) for sentid in sentences_
+            }:
+                raise InvalidSentencesQuantity()
+            sentences_ = [image_result_[str(sentid)] for sentid in sentences_]
+            if any(
+                not isinstance(sentence_, str) or len(sentence_) <= 10
+                for sentence_ in sentences_
+            ):
+                raise InvalidSentenceSize()
+            return sentences_
+
+        def parse_response(response_text_):
+            json_result_ = json.loads(response_text_)
+            if not isinstance(json_result_, dict):
+                raise InvalidAnswer()
+            translations_ = {}
+            for image_id_, sentences_ in pack:
+                try:
+                    translations_[image_id_] = parse_image_response(
+                        json_result_.get(str(image_id_)), sentences_
                     )
-                    try:
-                        parse_response(response_text)
-                    except JSONDecodeError:
-                        self.write_wrong_answer_to_disk(original_response_text)
-                        # Try to parse again replacing \" for ", that's a common llm error
-                        response_text = response_text.replace('\\"', '"')
-                        parse_response(response_text)
-                    break
-                except (
-                    JSONDecodeError,
-                    InvalidSentencesQuantity,
-                    InvalidAnswer,
-                    InvalidSentenceSize,
-                ):
+                except (InvalidSentencesQuantity, InvalidSentenceSize):
                     continue
+            return translations_
+
+        reponse = await self.rate_limiter.run(
+            lambda: self.groq_client.chat.completions.create(
+                messages=[
+                    {
+                        "role": "user",
+                        "content": prompt,
+                    }
+                ],
+                model=self.base_llm_model,
+            )
+        )
 
-        return translated_sentences_matrix
+        self.requests_made += 1
+
+        if self.requests_made >= 14400:
+            raise Exception("Requests per day limit reached...")
+
+        original_response_text = reponse.choices[0].message.content
+        try:
+            response_text = self.assert_valid_answer(
+                copy(original_response_text), check_length=False
+            )
+            try:
+                translations = parse_response(response_text)
+            except JSONDecodeError:
+                self.write_wrong_answer_to_disk(original_response_text)
+                # Try to parse again replacing \" for ", that's a common llm error
+                response_text = response_text.replace('\\"', '"')
+                translations = parse_response(response_text)
+        except (JSONDecodeError, InvalidAnswer):
+            return {}
+        if len(translations) < len(pack):
+            self.write_wrong_answer_to_disk(original_response_text)
+        return translations
 
 
 async def main():
@@ -256,10 +455,13 @@ async def main():
     os.makedirs(data_path, exist_ok=True)
 
     groq_translator = GroqTranslate(
-        checkpoint_path=checkpoint_path, output_path=data_path
+        checkpoint_path=checkpoint_path, output_path=data_path, journal_output=True
     )
 
-    await groq_translator.translate_sentences()
+    try:
+        await groq_translator.translate_sentences()
+    finally:
+        groq_translator.compact_journal()
 
 
 if __name__ == "__main__":
@@ -6,6 +6,7 @@ It keeps track of already done translations and avoid to repeat them
 
 import asyncio
 import os
+import time
 from pathlib import Path
 
 from translation.base_translator import BaseTranslator
@@ -24,6 +25,10 @@ class LibreTranslate(BaseTranslator):
         / "flickr30k_dataset.json",
         source_language: str = "en",
         dest_language: str = "pt",
+        journal_output: bool = False,
+        use_cache: bool = True,
+        max_concurrent_batches: int = 4,
+        target_latency: float = 10.0,
     ):
         """
         LibreTranslate Translator
@@ -33,6 +38,10 @@ class LibreTranslate(BaseTranslator):
         :param output_path: Where the translated json should be saved.
         :param source_language: The source language of translation.
         :param dest_language: The destination language of translation.
+        :param journal_output: Append the translated images to a jsonl journal, see BaseTranslator.
+        :param use_cache: Use the translation cache, see BaseTranslator.
+        :param max_concurrent_batches: Batches sent to the api at the same time.
+        :param target_latency: Seconds a batch should take, the number of images per batch is adapted to it.
         """
         super().__init__(
             translator_identifier="libretranslate",
@@ -41,48 +50,112 @@ class LibreTranslate(BaseTranslator):
             source_json=source_json,
             source_language=source_language,
             dest_language=dest_language,
+            journal_output=journal_output,
+            use_cache=use_cache,
         )
+        self.api_url = "http://127.0.0.1:5000/translate"
+        self.max_concurrent_batches = max_concurrent_batches
+        self.target_latency = target_latency
+        # bounds of max_sentence_batches when it is adapted to target_latency
+        self.min_sentence_batches = 1
+        self.max_sentence_batches_limit = 500
+        # created by translate_sentences, its connections are kept alive between batches
+        self.client = None
 
     async def translate_sentences(self):
-        translating_img_ids = []
-        translating_sentences = []
-        images = self._flickr_source_json["images"]
-        infos_dict = {}
-
-        for image in tqdm(images):
-            image_id = image["imgid"]
-            infos_dict[image_id] = image
-            if str(image_id) not in self._checkpoint_dictionary:
-                translating_img_ids.append(image_id)
-                translating_sentences.append(
-                    "\n".join([sentence["raw"] for sentence in image["sentences"]])
-                )
-
-            if (
-                len(translating_img_ids) >= self.max_sentence_batches
-                or image_id == images[-1]["imgid"]
-            ):
-                results = await self.send_sentences_to_api(translating_sentences)
-                parse_coros = []
-                for index, result in enumerate(results):
-                    image_id = translating_img_ids[index]
-                    translated_sentences = result.split("\n")
-                    translation_dict = infos_dict[image_id]
-                    for sentid, sentence in enumerate(translation_dict["sentences"]):
-                        sentence["raw"] = translated_sentences[sentid]
-                        sentence["tokens"] = (
-                            translated_sentences[sentid].strip(". ").lower().split()
-                        )
-                    checkpoint_data = {image_id: "ok"}
-                    parse_coros.append(
-                        self.append_translated_sentences_to_output(
-                            translation_dict, checkpoint_data
+        images = [
+            image
+            for image in self._flickr_source_json["images"]
+            if str(image["imgid"]) not in self._checkpoint_dictionary
+        ]
+        batch_slots = asyncio.Semaphore(self.max_concurrent_batches)
+        batch_tasks = []
+
+        self.client = httpx.AsyncClient(
+            timeout=300,
+            limits=httpx.Limits(
+                max_connections=self.max_concurrent_batches,
+                max_keepalive_connections=self.max_concurrent_batches,
+            ),
+        )
+        try:
+            with tqdm(total=len(images)) as progress:
+                start = 0
+                while start < len(images):
+                    await batch_slots.acquire()
+                    if any(
+                        task.done() and not task.cancelled() and task.exception()
+                        for task in batch_tasks
+                    ):
+                        # a batch failed, its error is raised by gather
+                        batch_slots.release()
+                        break
+                    # the size of the next batch is the one adapted to the
+                    # latency of the batches done so far
+                    batch = images[start : start + self.max_sentence_batches]
+                    start += len(batch)
+                    batch_tasks.append(
+                        asyncio.create_task(
+                            self.translate_batch(batch, batch_slots, progress)
                         )
                     )
+                await asyncio.gather(*batch_tasks)
+        finally:
+            # a failed batch stops the others
+            for task in batch_tasks:
+                task.cancel()
+            await self.client.aclose()
+            self.client = None
+
+    async def translate_batch(
+        self, images: [dict], batch_slots: asyncio.Semaphore, progress: tqdm
+    ):
+        """
+        Translates a batch of images and appends them to the output, then releases its slot.
+        """
+        try:
+            translations = await self.translate_missing_sentences(
+                images, self.send_missing_sentences
+            )
+            parse_coros = []
+            for translation_dict in images:
+                image_id = translation_dict["imgid"]
+                translated_sentences = translations[image_id]
+                for sentid, sentence in enumerate(translation_dict["sentences"]):
+                    sentence["raw"] = translated_sentences[sentid]
+                    sentence["tokens"] = (
+                        translated_sentences[sentid].strip(". ").lower().split()
+                    )
+                checkpoint_data = {image_id: "ok"}
+                parse_coros.append(
+                    self.append_translated_sentences_to_output(
+                        translation_dict, checkpoint_data
+                    )
+                )
+
+            await asyncio.gather(*parse_coros)
+            progress.update(len(images))
+        finally:
+            batch_slots.release()
+
+    async def send_missing_sentences(self, images_sentences: dict) -> [[str]]:
+        """
+        Sends the sentences of translate_missing_sentences, the ones of an image joined by new lines
+        """
+        results = await self.send_sentences_to_api(
+            ["\n".join(sentences.values()) for sentences in images_sentences.values()]
+        )
+        return [result.split("\n") for result in results]
 
-                await asyncio.gather(*parse_coros)
-                translating_img_ids = []
-                translating_sentences = []
+    def adapt_batch_size(self, latency: float):
+        """
+        Scales max_sentence_batches towards target_latency, from the latency of the last batch.
+        """
+        scale = min(2.0, max(0.5, self.target_latency / max(latency, 1e-3)))
+        self.max_sentence_batches = min(
+            self.max_sentence_batches_limit,
+            max(self.min_sentence_batches, round(self.max_sentence_batches * scale)),
+        )
 
     async def send_sentences_to_api(self, sentences: [str]) -> (int, [str]):
         """
@@ -95,11 +168,11 @@ class LibreTranslate(BaseTranslator):
             "format": "text",
             "api_key": "",
         }
-        async with httpx.AsyncClient(timeout=300) as client:
-            response = await client.post(
-                "http://127.0.0.1:5000/translate", json=json_data
-            )
-            translated_sentences = response.json()["translatedText"]
+        started_at = time.monotonic()
+        response = await self.client.post(self.api_url, json=json_data)
+        response.raise_for_status()
+        translated_sentences = response.json()["translatedText"]
+        self.adapt_batch_size(time.monotonic() - started_at)
 
         return translated_sentences
 
@@ -112,10 +185,13 @@ async def main():
     os.makedirs(data_path, exist_ok=True)
 
     libre_translator = LibreTranslate(
-        checkpoint_path=checkpoint_path, output_path=data_path
+        checkpoint_path=checkpoint_path, output_path=data_path, journal_output=True
     )
 
-    await libre_translator.translate_sentences()
+    try:
+        await libre_translator.translate_sentences()
+    finally:
+        libre_translator.compact_journal()
 
 
 if __name__ == "__main__":
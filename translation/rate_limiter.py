@@ -0,0 +1,104 @@
+"""
+Async request scheduler for the api based translators.
+
+It keeps the requests under the rate limits of a provider (sliding windows for the requests per minute and per day),
+bounds the number of requests in flight and retries the failed ones with an exponential backoff.
+"""
+
+import asyncio
+import collections
+import random
+import time
+
+
+class SlidingWindow:
+    def __init__(self, max_requests: int, period: float):
+        """
+        Rate limit over a sliding window: no period seconds hold more than max_requests requests
+
+        :param max_requests: Requests allowed per period.
+        :param period: Seconds of the window.
+        """
+        self.max_requests = max_requests
+        self.period = period
+        # start times of the requests of the last period, oldest first
+        self.request_times = collections.deque()
+
+    def wait_time(self) -> float:
+        """
+        Seconds until a request is allowed.
+        """
+        now = time.monotonic()
+        while self.request_times and self.request_times[0] <= now - self.period:
+            self.request_times.popleft()
+        if len(self.request_times) < self.max_requests:
+            return 0.0
+        return self.request_times[0] + self.period - now
+
+    def take(self):
+        self.request_times.append(time.monotonic())
+
+
+class RateLimiter:
+    def __init__(
+        self,
+        requests_per_minute: int,
+        requests_per_day: int = None,
+        max_concurrency: int = 8,
+        max_retries: int = 5,
+        base_backoff: float = 1.0,
+        max_backoff: float = 60.0,
+        retry_exceptions: tuple = (),
+    ):
+        """
+        Request scheduler
+
+        :param requests_per_minute: Requests allowed per minute.
+        :param requests_per_day: Requests allowed per day, unlimited if None.
+        :param max_concurrency: Requests in flight at the same time.
+        :param max_retries: Retries of a request raising one of retry_exceptions, before raising it.
+        :param base_backoff: Seconds before the first retry, doubled at each retry.
+        :param max_backoff: Maximum seconds between two retries.
+        :param retry_exceptions: Exceptions (rate limit, connection, server errors) after which a request is retried.
+        """
+        self.windows = [SlidingWindow(requests_per_minute, 60)]
+        if requests_per_day is not None:
+            self.windows.append(SlidingWindow(requests_per_day, 24 * 60 * 60))
+        self.semaphore = asyncio.Semaphore(max_concurrency)
+        self.lock = asyncio.Lock()
+        self.max_retries = max_retries
+        self.base_backoff = base_backoff
+        self.max_backoff = max_backoff
+        self.retry_exceptions = retry_exceptions
+
+    async def acquire(self):
+        """
+        Waits until every window allows a request and records it.
+        """
+        async with self.lock:
+            while True:
+                wait_time = max(window.wait_time() for window in self.windows)
+                if wait_time <= 0:
+                    break
+                await asyncio.sleep(wait_time)
+            for window in self.windows:
+                window.take()
+
+    async def run(self, request_factory):
+        """
+        Runs a request within the limits.
+
+        :param request_factory: Function returning the coroutine of the request, called again for each retry.
+        :return: The result of the request.
+        """
+        for attempt in range(self.max_retries + 1):
+            async with self.semaphore:
+                await self.acquire()
+                try:
+                    return await request_factory()
+                except self.retry_exceptions:
+                    if attempt == self.max_retries:
+                        raise
+            backoff = min(self.max_backoff, self.base_backoff * 2**attempt)
+            # jitter, so that the failed concurrent requests don't retry together
+            await asyncio.sleep(backoff * random.uniform(0.5, 1.0))
@@ -0,0 +1,107 @@
+"""
+Sentence level translation cache, in a SQLite file shared by the translators and their runs.
+
+A translation is keyed by the normalized source sentence, the language pair and the translator, so the repeated
+captions of the dataset are only sent once to each translator.
+"""
+
+import hashlib
+import json
+import re
+import sqlite3
+from pathlib import Path
+
+
+class TranslationCache:
+    # sqlite limits the number of parameters of a query
+    max_query_keys = 500
+
+    def __init__(self, path: Path):
+        """
+        Translation cache
+
+        :param path: The path to the SQLite file, created if it doesn't exist.
+        """
+        self.path = path
+        self.connection = sqlite3.connect(path)
+        # several translators may use the same file at the same time
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS translations ("
+            "key TEXT PRIMARY KEY, translator TEXT, source_language TEXT, "
+            "dest_language TEXT, sentence TEXT, translation TEXT)"
+        )
+        self.connection.commit()
+
+    @staticmethod
+    def normalize(sentence: str) -> str:
+        """
+        Normalizes a sentence: case, spaces and spaces before punctuation are ignored.
+        """
+        sentence = " ".join(sentence.split())
+        sentence = re.sub(r" ([.,;:!?])", r"\1", sentence)
+        return sentence.casefold()
+
+    def key(
+        self, sentence: str, source_language: str, dest_language: str, translator: str
+    ) -> str:
+        return hashlib.sha256(
+            json.dumps(
+                [translator, source_language, dest_language, self.normalize(sentence)]
+            ).encode()
+        ).hexdigest()
+
+    def get_many(
+        self,
+        sentences: [str],
+        source_language: str,
+        dest_language: str,
+        translator: str,
+    ) -> [str]:
+        """
+        Looks sentences up in the cache.
+
+        :return: The translation of each sentence, None for the sentences not in the cache.
+        """
+        keys = [
+            self.key(sentence, source_language, dest_language, translator)
+            for sentence in sentences
+        ]
+        found = {}
+        for start in range(0, len(keys), self.max_query_keys):
+            chunk = keys[start : start + self.max_query_keys]
+            found.update(
+                self.connection.execute(
+                    "SELECT key, translation FROM translations WHERE key IN "
+                    f"({', '.join('?' * len(chunk))})",
+                    chunk,
+                )
+            )
+        return [found.get(key) for key in keys]
+
+    def put_many(
+        self,
+        sentences: [str],
+        translations: [str],
+        source_language: str,
+        dest_language: str,
+        translator: str,
+    ):
+        """
+        Adds the translations of sentences to the cache.
+        """
+        self.connection.executemany(
+            "INSERT OR REPLACE INTO translations VALUES (?, ?, ?, ?, ?, ?)",
+            [
+                (
+                    self.key(sentence, source_language, dest_language, translator),
+                    translator,
+                    source_language,
+                    dest_language,
+                    sentence,
+                    translation,
+                )
+                for sentence, translation in zip(sentences, translations)
+            ],
+        )
+        self.connection.commit()